@@ -0,0 +1,31 @@
+# backend/conftest.py
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_wizard_state(monkeypatch):
+    """Each test starts without prepared reviews or wizard memory."""
+    monkeypatch.setattr(main, "_prepared", main.OrderedDict())
+    monkeypatch.setattr(main, "_wizard_memory", main.OrderedDict())
+    monkeypatch.setattr(main, "_prepared_stats", {k: 0 for k in main._prepared_stats})
+
+
+@pytest.fixture
+def wizard_payload():
+    """Factory for /wizard-review command payloads on one PR."""
+
+    def _make(files=None, sha="head1", body="/wizard-review"):
+        if files is None:
+            files = [main.FileInfo(filename="a.py", status="modified", patch="@@ -1 +1 @@\n-x\n+y\n")]
+        return main.ReviewPayload(
+            kind="wizard_review_command",
+            comment_body=body,
+            pr_number=3,
+            pr_head_sha=sha,
+            repo_full_name="octo/repo",
+            files=files,
+        )
+
+    return _make
@@ -5,8 +5,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from typing import List, Optional, Literal, Callable, TypeVar
-from fastapi import FastAPI
+from typing import List, Optional, Literal, Callable, TypeVar, Tuple
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
 import os
 import json
@@ -14,10 +15,22 @@ import sys
 import time
 import random
 import re
+import math
+import asyncio
+import threading
+import hashlib
+import uuid
+import contextvars
+import hmac
+import functools
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import anyio
 from google import genai
 
+from replay import load_capture_records
+
 types = genai.types  # alias for convenience
 app = FastAPI()
 
@@ -29,6 +42,78 @@ RETRY_MAX_DELAY_SEC = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "2.0"))
 RETRY_MAX_ATTEMPTS = int(os.getenv("GEMINI_RETRY_MAX_ATTEMPTS", "12"))
 RETRY_JITTER_SEC = float(os.getenv("GEMINI_RETRY_JITTER_SEC", "0.10"))
 
+# ----------------------------
+# Hedging config (tune here)
+# ----------------------------
+HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "0").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY_SEC = float(os.getenv("GEMINI_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_DELAY_SEC = float(os.getenv("GEMINI_HEDGE_MAX_DELAY", "15.0"))
+HEDGE_DEFAULT_DELAY_SEC = float(os.getenv("GEMINI_HEDGE_DEFAULT_DELAY", "6.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("GEMINI_HEDGE_WINDOW", "200"))
+HEDGE_BUDGET_RATIO = float(os.getenv("GEMINI_HEDGE_BUDGET_RATIO", "0.05"))  # extra calls per primary call
+HEDGE_BUDGET_BURST = float(os.getenv("GEMINI_HEDGE_BUDGET_BURST", "5"))
+HEDGE_MAX_WORKERS = int(os.getenv("GEMINI_HEDGE_MAX_WORKERS", "16"))
+
+# ----------------------------
+# Traffic capture / replay config (tune here)
+# ----------------------------
+CAPTURE_DIR = os.getenv("CONTEXTWIZARD_CAPTURE_DIR", "")  # empty = capture disabled
+CAPTURE_MAX_BYTES = int(os.getenv("CONTEXTWIZARD_CAPTURE_MAX_BYTES", str(50 * 1024 * 1024)))
+CAPTURE_MAX_FILES = int(os.getenv("CONTEXTWIZARD_CAPTURE_MAX_FILES", "10"))
+REPLAY_FROM = os.getenv("GEMINI_REPLAY_FROM", "")  # capture file/dir; non-empty = serve recorded responses
+REPLAY_LATENCY_SCALE = float(os.getenv("GEMINI_REPLAY_LATENCY_SCALE", "1.0"))  # 0 = no simulated model latency
+REPLAY_ID_HEADER = "x-contextwizard-capture-id"
+
+# ----------------------------
+# Suggestion validation config (tune here)
+# ----------------------------
+SUGGESTION_VALIDATE = os.getenv("CONTEXTWIZARD_VALIDATE_SUGGESTIONS", "1").lower() in ("1", "true", "yes")
+SUGGESTION_REPAIR_MAX_ATTEMPTS = int(os.getenv("CONTEXTWIZARD_REPAIR_MAX_ATTEMPTS", "3"))
+SUGGESTION_REPAIR_REF_LINES = int(os.getenv("CONTEXTWIZARD_REPAIR_REF_LINES", "60"))
+
+# ----------------------------
+# Prompt prefix cache config (tune here)
+# ----------------------------
+PROMPT_CACHE_ENABLED = os.getenv("GEMINI_PROMPT_CACHE_ENABLED", "0").lower() in ("1", "true", "yes")
+PROMPT_CACHE_TTL_SEC = int(os.getenv("GEMINI_PROMPT_CACHE_TTL_SEC", "3600"))
+PROMPT_CACHE_REFRESH_MARGIN_SEC = int(os.getenv("GEMINI_PROMPT_CACHE_REFRESH_MARGIN_SEC", "300"))
+PROMPT_CACHE_MIN_CHARS = int(os.getenv("GEMINI_PROMPT_CACHE_MIN_CHARS", "8000"))  # provider minimum is token-based
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_PROMPT_CACHE_MAX_ENTRIES", "256"))
+PROMPT_CACHE_FAILURE_BACKOFF_SEC = float(os.getenv("GEMINI_PROMPT_CACHE_FAILURE_BACKOFF_SEC", "600"))
+
+# ----------------------------
+# Admin / profiling config (tune here)
+# ----------------------------
+ADMIN_TOKEN = os.getenv("CONTEXTWIZARD_ADMIN_TOKEN", "")  # empty = admin endpoints and tracing disabled
+PROFILE_MAX_SECONDS = float(os.getenv("CONTEXTWIZARD_PROFILE_MAX_SECONDS", "120"))
+PROFILE_MAX_HZ = int(os.getenv("CONTEXTWIZARD_PROFILE_MAX_HZ", "500"))
+ADMIN_TOKEN_HEADER = "x-admin-token"
+TRACE_HEADER = "x-contextwizard-trace"
+
+# ----------------------------
+# Credential pool config (tune here)
+# ----------------------------
+KEY_RPM = int(os.getenv("GEMINI_KEY_RPM", "0"))  # per-key requests/minute; 0 = unknown, route by least load
+KEY_SIDELINE_SEC = float(os.getenv("GEMINI_KEY_SIDELINE_SEC", "5"))
+KEY_MAX_SIDELINE_SEC = float(os.getenv("GEMINI_KEY_MAX_SIDELINE_SEC", "30"))
+# When every key is sidelined, a call waits this long for the first one to return (never less than the max sideline).
+KEY_ACQUIRE_MAX_WAIT_SEC = float(os.getenv("GEMINI_KEY_ACQUIRE_MAX_WAIT_SEC", "30"))
+
+# ----------------------------
+# Wizard review memory config (tune here)
+# ----------------------------
+WIZARD_MEMORY_MAX_PRS = int(os.getenv("CONTEXTWIZARD_WIZARD_MEMORY_MAX_PRS", "500"))
+WIZARD_MERGED_MAX_COMMENTS = int(os.getenv("CONTEXTWIZARD_WIZARD_MERGED_MAX_COMMENTS", "12"))
+
+# ----------------------------
+# PR precompute config (tune here)
+# ----------------------------
+PREPARE_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXTWIZARD_PREPARE_MAX_ENTRIES", "200"))
+PREPARE_CACHE_TTL_SEC = float(os.getenv("CONTEXTWIZARD_PREPARE_TTL_SEC", str(6 * 3600)))
+PREPARE_MAX_CONCURRENCY = int(os.getenv("CONTEXTWIZARD_PREPARE_MAX_CONCURRENCY", "2"))
+
 
 # ----------------------------
 # Payload models
@@ -80,10 +165,12 @@ class ReviewPayload(BaseModel):
     pr_title: Optional[str] = None
     pr_body: Optional[str] = None
     pr_author_login: Optional[str] = None
+    pr_head_sha: Optional[str] = None
     repo_full_name: str
     repo_owner: Optional[str] = None
     repo_name: Optional[str] = None
     repo_default_branch: Optional[str] = None
+    repo_default_branch_sha: Optional[str] = None
 
     files: Optional[List[FileInfo]] = None
 
@@ -98,6 +185,11 @@ class BackendResponse(BaseModel):
     comment: str
 
 
+class PrepareResponse(BaseModel):
+    status: str  # "scheduled" | "cached" | "in_progress" | "skipped"
+    head_sha: Optional[str] = None
+
+
 # ----------------------------
 # Gemini structured output models
 # ----------------------------
@@ -154,14 +246,366 @@ class CandidateReviewOutput(BaseModel):
     comments: List[CandidateReviewComment] = Field(default_factory=list)
 
 
+# ----------------------------
+# Admin: per-request trace + sampling profiler
+# ----------------------------
+class RequestTrace:
+    """Span timings for one traced request; shared by the event loop and worker threads."""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans: List[Tuple[str, float, float]] = []  # (name, start offset sec, duration sec)
+
+    def add(self, name: str, start: float, end: float) -> None:
+        with self._lock:
+            self.spans.append((name, start - self.t0, max(0.0, end - start)))
+
+    def server_timing(self) -> str:
+        with self._lock:
+            spans = list(self.spans)
+        parts = []
+        for i, (name, _, dur) in enumerate(spans):
+            token = re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+            parts.append(f"{i}-{token};dur={dur * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_trace_ctx: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("request_trace", default=None)
+
+
+class trace_span:
+    """`with trace_span("name"):` records a span when the current request is traced; no-op otherwise."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace = None
+        self.start = 0.0
+
+    def __enter__(self):
+        self.trace = _trace_ctx.get()
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.start, time.perf_counter())
+        return False
+
+
+def traced(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+async def run_in_thread(name: str, fn: Callable[..., T], *args) -> T:
+    """anyio.to_thread.run_sync that records thread-pool queue wait separately from run time."""
+    trace = _trace_ctx.get()
+    if trace is None:
+        return await anyio.to_thread.run_sync(fn, *args)
+
+    submitted = time.perf_counter()
+
+    def _runner():
+        started = time.perf_counter()
+        trace.add(f"{name}.queue_wait", submitted, started)
+        try:
+            return fn(*args)
+        finally:
+            trace.add(f"{name}.run", started, time.perf_counter())
+
+    return await anyio.to_thread.run_sync(_runner)
+
+
+def is_admin_request(request: Request) -> bool:
+    supplied = request.headers.get(ADMIN_TOKEN_HEADER, "")
+    # Compare bytes: compare_digest rejects non-ASCII str, and headers arrive latin-1 decoded.
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def require_admin(request: Request) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin_request(request):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+_profile_lock = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def sample_collapsed_stacks(seconds: float, hz: int) -> str:
+    """
+    Sample every thread's Python stack at `hz` for `seconds` and return
+    flamegraph.pl / speedscope compatible collapsed stacks ("a;b;c count").
+    """
+    interval = 1.0 / max(1, hz)
+    me = threading.get_ident()
+    names = {}
+    counts: dict = {}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        if len(names) != threading.active_count():
+            names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            f = frame
+            while f is not None:
+                stack.append(_frame_label(f))
+                f = f.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+
+    return "\n".join(f"{k} {v}" for k, v in sorted(counts.items(), key=lambda kv: -kv[1])) + "\n"
+
+
+# ----------------------------
+# Gemini credential pool
+# ----------------------------
+_THROTTLE_MARKERS = ("429", "resource exhausted", "resource_exhausted", "quota", "rate limit")
+_RETRY_DELAY_RE = re.compile(r"retry_?delay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", re.IGNORECASE)
+
+
+def _is_throttle_error(exc: Exception) -> bool:
+    msg = (str(exc) or "").lower()
+    return any(m in msg for m in _THROTTLE_MARKERS)
+
+
+class CacheOwnerThrottled(RuntimeError):
+    """The key that owns a cached content is sidelined; send this call inline, the cache itself is fine."""
+
+
+class _KeyState:
+    def __init__(self, index: int, api_key: str, client):
+        self.label = f"key-{index + 1} (…{api_key[-4:]})"
+        self.client = client
+        self.recent: deque = deque()  # monotonic timestamps of requests in the last 60s
+        self.in_flight = 0
+        self.sidelined_until = 0.0
+        self.consecutive_throttles = 0
+        self.last_sideline_sec = 0.0
+        self.stats = {"requests": 0, "successes": 0, "errors": 0, "throttled": 0, "sidelined": 0}
+
+
+class _PoolModels:
+    def __init__(self, pool: "CredentialPool"):
+        self._pool = pool
+
+    def generate_content(self, **kwargs):
+        cached = getattr(kwargs.get("config"), "cached_content", None)
+        owner = self._pool.cache_owner(cached) if cached else None
+        return self._pool.call(lambda c: c.models.generate_content(**kwargs), owner=owner)[1]
+
+
+class _PoolCaches:
+    def __init__(self, pool: "CredentialPool"):
+        self._pool = pool
+
+    def create(self, **kwargs):
+        key, cc = self._pool.call(lambda c: c.caches.create(**kwargs))
+        self._pool.set_cache_owner(cc.name, key)
+        return cc
+
+    def update(self, *, name: str, **kwargs):
+        return self._pool.call(lambda c: c.caches.update(name=name, **kwargs), owner=self._pool.cache_owner(name))[1]
+
+
+class CredentialPool:
+    """
+    Several Gemini API keys behind one client-shaped object. Each call goes to
+    the key with the most rate-limit headroom; keys that hit 429/quota errors
+    are sidelined for a while (honouring the provider's retryDelay if given),
+    and when every key is sidelined a call waits for the first to come back.
+    A single-key pool never sidelines. Cached contents stay on the key that
+    created them; while that key is sidelined, prompts using them go inline.
+    """
+
+    def __init__(
+        self,
+        api_keys: List[str],
+        client_factory: Callable[[str], object],
+        rpm_per_key: int = 0,
+        sideline_sec: float = 5.0,
+        max_sideline_sec: float = 30.0,
+        max_acquire_wait_sec: float = 30.0,
+    ):
+        if not api_keys:
+            raise RuntimeError("GEMINI_API_KEY is not set")
+        self.rpm_per_key = rpm_per_key
+        self.sideline_sec = sideline_sec
+        self.max_sideline_sec = max_sideline_sec
+        # Waiting out the longest sideline inside acquire() keeps a throttled call within the retry budget.
+        self.max_acquire_wait_sec = max(max_acquire_wait_sec, max_sideline_sec)
+        self._lock = threading.Lock()
+        self._keys = [_KeyState(i, k, client_factory(k)) for i, k in enumerate(api_keys)]
+        self._cache_owner: OrderedDict = OrderedDict()  # cached content name -> _KeyState
+        self.models = _PoolModels(self)
+        self.caches = _PoolCaches(self)
+
+    def _headroom(self, key: _KeyState, now: float) -> float:
+        while key.recent and now - key.recent[0] > 60.0:
+            key.recent.popleft()
+        used = len(key.recent) + key.in_flight
+        return (self.rpm_per_key - used) if self.rpm_per_key > 0 else -used
+
+    def acquire(self, owner: Optional[_KeyState] = None) -> _KeyState:
+        deadline = time.monotonic() + self.max_acquire_wait_sec
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if owner is not None:
+                    if owner.sidelined_until > now:
+                        raise CacheOwnerThrottled(f"cached content owner {owner.label} is throttled; try again")
+                    chosen = owner
+                else:
+                    live = [k for k in self._keys if k.sidelined_until <= now]
+                    if not live:
+                        free_at = min(k.sidelined_until for k in self._keys)
+                        if free_at > deadline:
+                            raise RuntimeError(
+                                f"rate limit: all Gemini keys sidelined for another {free_at - now:.1f}s; try again"
+                            )
+                        chosen = None
+                    else:
+                        chosen = max(live, key=lambda k: self._headroom(k, now))
+
+                if chosen is not None:
+                    chosen.recent.append(now)
+                    chosen.in_flight += 1
+                    chosen.stats["requests"] += 1
+                    return chosen
+
+            time.sleep(max(0.0, free_at - time.monotonic()) + 0.01)
+
+    def release(self, key: _KeyState, exc: Optional[Exception] = None) -> None:
+        with self._lock:
+            key.in_flight -= 1
+            if exc is None:
+                key.stats["successes"] += 1
+                key.consecutive_throttles = 0
+                return
+            if not _is_throttle_error(exc):
+                key.stats["errors"] += 1
+                return
+
+            key.stats["throttled"] += 1
+            if len(self._keys) == 1:
+                # Nowhere else to route: leave backoff to gemini_call_with_retry as before pooling.
+                return
+
+            now = time.monotonic()
+            if key.sidelined_until and now - key.sidelined_until > key.last_sideline_sec:
+                # Healthy for a full sideline period since it came back; start the backoff over.
+                key.consecutive_throttles = 0
+            key.consecutive_throttles += 1
+            m = _RETRY_DELAY_RE.search(str(exc))
+            if m:
+                delay = float(m.group(1))
+            else:
+                delay = self.sideline_sec * (2 ** (key.consecutive_throttles - 1))
+            delay = min(self.max_sideline_sec, delay)
+            key.last_sideline_sec = delay
+            key.sidelined_until = max(key.sidelined_until, now + delay)
+            key.stats["sidelined"] += 1
+        print(f"[gemini-pool] {key.label} throttled; sidelined for {delay:.1f}s", file=sys.stderr)
+
+    def call(self, fn: Callable[[object], T], owner: Optional[_KeyState] = None) -> Tuple[_KeyState, T]:
+        key = self.acquire(owner)
+        try:
+            out = fn(key.client)
+        except Exception as e:
+            self.release(key, e)
+            raise
+        self.release(key)
+        return key, out
+
+    def cache_owner(self, name: str) -> Optional[_KeyState]:
+        with self._lock:
+            return self._cache_owner.get(name)
+
+    def cache_owner_available(self, name: str) -> bool:
+        with self._lock:
+            owner = self._cache_owner.get(name)
+            return owner is None or owner.sidelined_until <= time.monotonic()
+
+    def set_cache_owner(self, name: str, key: _KeyState) -> None:
+        with self._lock:
+            self._cache_owner[name] = key
+            self._cache_owner.move_to_end(name)
+            while len(self._cache_owner) > 1024:
+                self._cache_owner.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            keys = []
+            for k in self._keys:
+                headroom = self._headroom(k, now)
+                keys.append(
+                    {
+                        "key": k.label,
+                        **k.stats,
+                        "in_flight": k.in_flight,
+                        "requests_last_60s": len(k.recent),
+                        "headroom": headroom if self.rpm_per_key > 0 else None,
+                        "sidelined_for_sec": round(max(0.0, k.sidelined_until - now), 1),
+                    }
+                )
+            return {"rpm_per_key": self.rpm_per_key or None, "keys": keys}
+
+
+_credential_pool: Optional[CredentialPool] = None
+_credential_pool_lock = threading.Lock()
+
+
+def gemini_api_keys() -> List[str]:
+    keys = [k.strip() for k in os.getenv("GEMINI_API_KEYS", "").split(",") if k.strip()]
+    single = (os.getenv("GEMINI_API_KEY") or "").strip()
+    if single and single not in keys:
+        keys.append(single)
+    return keys
+
+
+def credentials_snapshot() -> dict:
+    pool = _credential_pool
+    return pool.snapshot() if pool is not None else {"keys": []}
+
+
 # ----------------------------
 # Helpers
 # ----------------------------
-def get_client() -> genai.Client:
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY is not set")
-    return genai.Client(api_key=api_key)
+def get_client() -> CredentialPool:
+    global _credential_pool
+    if REPLAY_FROM:
+        return get_replay_client()
+    with _credential_pool_lock:
+        if _credential_pool is None:
+            _credential_pool = CredentialPool(
+                gemini_api_keys(),
+                lambda k: genai.Client(api_key=k),
+                rpm_per_key=KEY_RPM,
+                sideline_sec=KEY_SIDELINE_SEC,
+                max_sideline_sec=KEY_MAX_SIDELINE_SEC,
+                max_acquire_wait_sec=KEY_ACQUIRE_MAX_WAIT_SEC,
+            )
+        return _credential_pool
 
 
 def clip(s: Optional[str], n: int) -> str:
@@ -170,6 +614,11 @@ def clip(s: Optional[str], n: int) -> str:
     return s if len(s) <= n else s[:n] + "\n…(truncated)…"
 
 
+# build_llm_context shows the model at most this many file patches.
+LLM_CONTEXT_MAX_PATCHES = 6
+
+
+@traced("build_llm_context")
 def build_llm_context(payload: ReviewPayload) -> str:
     pr_title = payload.pr_title or ""
     pr_body = clip(payload.pr_body, 1200)
@@ -251,29 +700,46 @@ Review body:
     # Diff context
     files = payload.files or []
     if files:
-        base += f"\n\nChanged files: {len(files)} (showing up to 6 patches, truncated)\n"
-        for f in files[:6]:
+        base += f"\n\nChanged files: {len(files)} (showing up to {LLM_CONTEXT_MAX_PATCHES} patches, truncated)\n"
+        for f in files[:LLM_CONTEXT_MAX_PATCHES]:
             base += (
                 f"\n---\nFILE: {f.filename}\nSTATUS: {f.status} "
                 f"(+{f.additions}/-{f.deletions}, changes={f.changes})\n"
                 f"PATCH:\n{clip(f.patch, 1200)}\n"
             )
 
-    # Project docs context (FR2.3)
+    return base.strip()
+
+
+@traced("build_static_context")
+def build_static_context(payload: ReviewPayload) -> str:
+    """Per-repo project docs (FR2.3). Kept apart from the PR context so it can lead the prompt as a stable prefix."""
     docs = payload.project_context_docs or []
-    if docs:
-        base += "\n\nProject context docs (configured):\n"
-        for d in docs[:6]:
-            label = f"[{d.kind}] " if d.kind else ""
-            base += (
-                f"\n---\nDOC: {label}{d.path}\n"
-                f"URL: {d.url or '(no url)'}\n"
-                f"EXCERPT:\n{clip(d.excerpt, 1400)}\n"
-            )
+    if not docs:
+        return ""
 
+    base = "Project context docs (configured):\n"
+    for d in docs[:6]:
+        label = f"[{d.kind}] " if d.kind else ""
+        base += (
+            f"\n---\nDOC: {label}{d.path}\n"
+            f"URL: {d.url or '(no url)'}\n"
+            f"EXCERPT:\n{clip(d.excerpt, 1400)}\n"
+        )
     return base.strip()
 
 
+M = TypeVar("M", bound=BaseModel)
+
+
+def parse_structured(resp, model_cls: type[M]) -> M:
+    with trace_span(f"validate.{model_cls.__name__}"):
+        data = getattr(resp, "parsed", None)
+        if data is None:
+            data = json.loads(resp.text)
+        return model_cls.model_validate(data)
+
+
 def extract_first_fenced_code_block(text: str) -> str:
     """
     Return ONLY the first fenced code block (```...```).
@@ -293,6 +759,573 @@ def extract_first_fenced_code_block(text: str) -> str:
     return f"```\n{text.strip()}\n```"
 
 
+# ----------------------------
+# Traffic capture / replay
+# ----------------------------
+_capture_ctx: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("capture_ctx", default=None)
+_replay_id_ctx: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("replay_id", default=None)
+
+_SECRET_PATTERNS = [
+    re.compile(r"-----BEGIN [A-Z ]*PRIVATE KEY-----.*?-----END [A-Z ]*PRIVATE KEY-----", re.DOTALL),
+    re.compile(r"\b(?:ghp|gho|ghs|ghu|ghr|github_pat)_[A-Za-z0-9_]{20,}\b"),
+    re.compile(r"\bAIza[0-9A-Za-z_-]{30,}\b"),
+    re.compile(r"\bsk-[A-Za-z0-9]{20,}\b"),
+]
+_SECRET_ASSIGNMENT = re.compile(r"(?i)\b(api[_-]?key|secret|token|password|passwd)(\s*[:=]\s*)[\"']?[^\s\"']+")
+
+
+def _pseudonymize(login: Optional[str]) -> Optional[str]:
+    if not login:
+        return login
+    return "user-" + hashlib.sha256(login.encode("utf-8")).hexdigest()[:10]
+
+
+def _redact_text(text: str) -> str:
+    for pat in _SECRET_PATTERNS:
+        text = pat.sub("<redacted>", text)
+    return _SECRET_ASSIGNMENT.sub(lambda m: f"{m.group(1)}{m.group(2)}<redacted>", text)
+
+
+def sanitize_for_capture(value, key: str = ""):
+    """Redact secrets in all strings and pseudonymize *_login fields, keeping sizes realistic."""
+    if isinstance(value, dict):
+        return {k: sanitize_for_capture(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [sanitize_for_capture(v, key) for v in value]
+    if isinstance(value, str):
+        if key.endswith("_login"):
+            return _pseudonymize(value)
+        return _redact_text(value)
+    return value
+
+
+class _CaptureWriter:
+    """Append-only JSONL writer that rotates by size and keeps the newest N files."""
+
+    def __init__(self, directory: str, max_bytes: int, max_files: int):
+        self.directory = directory
+        self.max_bytes = max(1, max_bytes)
+        self.max_files = max(1, max_files)
+        self._lock = threading.Lock()
+        self._path: Optional[str] = None
+
+    def _rotate(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        self._path = os.path.join(self.directory, f"capture-{stamp}-{uuid.uuid4().hex[:6]}.jsonl")
+        existing = sorted(
+            f for f in os.listdir(self.directory) if f.startswith("capture-") and f.endswith(".jsonl")
+        )
+        for old in existing[: max(0, len(existing) - self.max_files + 1)]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._path is None or (
+                os.path.exists(self._path) and os.path.getsize(self._path) + len(line) > self.max_bytes
+            ):
+                self._rotate()
+            with open(self._path, "a", encoding="utf-8") as fh:
+                fh.write(line)
+
+
+_capture_writer: Optional[_CaptureWriter] = (
+    _CaptureWriter(CAPTURE_DIR, CAPTURE_MAX_BYTES, CAPTURE_MAX_FILES) if CAPTURE_DIR else None
+)
+
+
+class _ReplayResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.parsed = None
+
+
+class _ReplayModels:
+    def __init__(self, records: List[dict]):
+        self._lock = threading.Lock()
+        self._by_id = {r["capture_id"]: r.get("model_calls") or [] for r in records if r.get("capture_id")}
+        self._cursor: dict = {}  # (capture_id, call_name) -> next index
+
+    def _next(self, call_name: str, kind: str) -> Optional[dict]:
+        capture_id = _replay_id_ctx.get()
+        calls = [
+            c
+            for c in self._by_id.get(capture_id or "", [])
+            if c.get("call_name") == call_name and c.get("kind", "attempt") == kind
+        ]
+        if not calls:
+            return None
+        with self._lock:
+            idx = self._cursor.get((capture_id, call_name, kind), 0)
+            self._cursor[(capture_id, call_name, kind)] = idx + 1
+        return calls[min(idx, len(calls) - 1)]
+
+    def generate_content(self, *, model: str, contents, config=None, call_name: str = ""):
+        rec = self._next(call_name, "attempt")
+        if rec is None:
+            raise RuntimeError(f"replay: no recorded response for capture={_replay_id_ctx.get()} call={call_name}")
+
+        if REPLAY_LATENCY_SCALE > 0:
+            time.sleep(float(rec.get("latency_sec", 0.0)) * REPLAY_LATENCY_SCALE)
+        if rec.get("outcome") == "error":
+            # Same message as the original failure, so the retry wrapper classifies it the same way.
+            raise RuntimeError(rec.get("error") or "replay: recorded model error")
+        return _ReplayResponse(rec.get("response_text") or "")
+
+    def next_retry_sleep(self, call_name: str) -> Optional[float]:
+        rec = self._next(call_name, "retry_sleep")
+        return float(rec.get("sleep_sec", 0.0)) if rec is not None else None
+
+
+class _ReplayCachedContent:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class _ReplayCaches:
+    """Accepts cached-content registrations locally so prompt caching works under replay."""
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+
+    def create(self, *, model: str, config=None):
+        self.created += 1
+        return _ReplayCachedContent(f"cachedContents/replay-{uuid.uuid4().hex[:12]}")
+
+    def update(self, *, name: str, config=None):
+        self.updated += 1
+        return _ReplayCachedContent(name)
+
+
+class ReplayClient:
+    """Local stand-in for genai.Client that serves model responses from a capture."""
+
+    def __init__(self, records: List[dict]):
+        self.models = _ReplayModels(records)
+        self.caches = _ReplayCaches()
+
+
+_replay_client: Optional[ReplayClient] = None
+
+
+def get_replay_client() -> ReplayClient:
+    global _replay_client
+    if _replay_client is None:
+        _replay_client = ReplayClient(load_capture_records(REPLAY_FROM))
+    return _replay_client
+
+
+def _record_model_call(call_name: str, started: float, **fields) -> None:
+    """Append one model attempt (successful or not) to the current capture record."""
+    cap = _capture_ctx.get()
+    if cap is not None:
+        cap["model_calls"].append(
+            {"call_name": call_name, "kind": "attempt", "latency_sec": round(time.monotonic() - started, 4), **fields}
+        )
+
+
+def _retry_sleep_for(call_name: str, computed: float) -> float:
+    """Record the retry backoff in the capture; under replay, wait as long as the original run did."""
+    if REPLAY_FROM and _replay_id_ctx.get():
+        recorded = get_replay_client().models.next_retry_sleep(call_name)
+        if recorded is not None:
+            computed = recorded * max(0.0, REPLAY_LATENCY_SCALE)
+    cap = _capture_ctx.get()
+    if cap is not None:
+        cap["model_calls"].append({"call_name": call_name, "kind": "retry_sleep", "sleep_sec": round(computed, 4)})
+    return computed
+
+
+def gemini_generate(client, call_name: str, **kwargs):
+    """Single choke point for generate_content so captures/replay see every model call."""
+    if isinstance(client, ReplayClient):
+        with trace_span(f"model.{call_name}"):
+            return client.models.generate_content(call_name=call_name, **kwargs)
+
+    started = time.monotonic()
+    try:
+        with trace_span(f"model.{call_name}"):
+            resp = client.models.generate_content(**kwargs)
+    except Exception as e:
+        _record_model_call(call_name, started, outcome="error", error=_redact_text(str(e)[:500]))
+        cached = getattr(kwargs.get("config"), "cached_content", None)
+        if cached and not isinstance(e, CacheOwnerThrottled) and "cache" in str(e).lower():
+            _prompt_cache.invalidate(cached)
+            raise RuntimeError(f"cached content {cached} rejected; try again without it: {str(e)[:160]}") from e
+        raise
+    _record_model_call(
+        call_name, started, outcome="ok", response_text=_redact_text(getattr(resp, "text", None) or "")
+    )
+    return resp
+
+
+# ----------------------------
+# Static prompt prefix + provider context caching
+# ----------------------------
+class PromptPrefixCache:
+    """
+    Maps a static prompt prefix (stage instructions + repo docs) to a provider
+    cached-content name. Keys include repo, default-branch SHA and a content hash,
+    so a docs change or a new SHA never reuses a stale prefix.
+    """
+
+    def __init__(self, ttl_sec: int, refresh_margin_sec: int, max_entries: int, failure_backoff_sec: float):
+        self.ttl_sec = max(60, ttl_sec)
+        self.refresh_margin_sec = max(0, min(refresh_margin_sec, self.ttl_sec // 2))
+        self.max_entries = max(1, max_entries)
+        self.failure_backoff_sec = failure_backoff_sec
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> {"name", "expires_at"}
+        self._failed_until: dict = {}
+        self._inflight: dict = {}  # key -> threading.Event while a create/refresh is running
+        self.single_flight_wait_sec = 30.0
+        self.stats = {"hits": 0, "creates": 0, "refreshes": 0, "failures": 0, "inline": 0, "invalidated": 0}
+
+    def invalidate(self, name: str) -> None:
+        """Drop a name the provider rejected and serve its key inline for the failure backoff."""
+        with self._lock:
+            until = time.monotonic() + self.failure_backoff_sec
+            for k in [k for k, v in self._entries.items() if v["name"] == name]:
+                del self._entries[k]
+                self._failed_until[k] = until
+            self.stats["invalidated"] += 1
+
+    def resolve(self, client, model: str, key: str, system_instruction: str, docs_text: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            live = entry is not None and entry["expires_at"] > now
+            if live:
+                self._entries.move_to_end(key)
+                needs_refresh = entry["expires_at"] - now < self.refresh_margin_sec
+                if not needs_refresh or key in self._inflight:
+                    self.stats["hits"] += 1
+                    return entry["name"]
+            if self._failed_until.get(key, 0.0) > now:
+                self.stats["inline"] += 1
+                return None
+
+            # Single-flight: one caller creates/refreshes a key, concurrent callers wait for it.
+            pending = self._inflight.get(key)
+            leader = pending is None
+            if leader:
+                pending = threading.Event()
+                self._inflight[key] = pending
+
+        if not leader:
+            pending.wait(timeout=self.single_flight_wait_sec)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry["expires_at"] > time.monotonic():
+                    self.stats["hits"] += 1
+                    return entry["name"]
+                self.stats["inline"] += 1
+                return None
+
+        try:
+            return self._create_or_refresh(client, model, key, entry if live else None, system_instruction, docs_text)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            pending.set()
+
+    def _create_or_refresh(
+        self,
+        client,
+        model: str,
+        key: str,
+        entry: Optional[dict],
+        system_instruction: str,
+        docs_text: str,
+    ) -> Optional[str]:
+        ttl = f"{self.ttl_sec}s"
+        if entry is not None:
+            try:
+                client.caches.update(name=entry["name"], config=types.UpdateCachedContentConfig(ttl=ttl))
+                with self._lock:
+                    entry["expires_at"] = time.monotonic() + self.ttl_sec
+                    self.stats["refreshes"] += 1
+                return entry["name"]
+            except CacheOwnerThrottled:
+                return entry["name"]  # still live; refresh once the owner key is back
+            except Exception as e:
+                print(f"[prompt-cache] refresh failed for {key}: {type(e).__name__}: {str(e)[:160]}", file=sys.stderr)
+
+        try:
+            cc = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name=key[:128],
+                    system_instruction=system_instruction,
+                    contents=[types.Content(role="user", parts=[types.Part(text=docs_text)])],
+                    ttl=ttl,
+                ),
+            )
+        except Exception as e:
+            print(f"[prompt-cache] create failed for {key}: {type(e).__name__}: {str(e)[:160]}", file=sys.stderr)
+            with self._lock:
+                self._failed_until[key] = time.monotonic() + self.failure_backoff_sec
+                self.stats["failures"] += 1
+                self.stats["inline"] += 1
+            return None
+
+        with self._lock:
+            self._entries[key] = {"name": cc.name, "expires_at": time.monotonic() + self.ttl_sec}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.stats["creates"] += 1
+        return cc.name
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": PROMPT_CACHE_ENABLED,
+                "entries": len(self._entries),
+                "ttl_sec": self.ttl_sec,
+                "refresh_margin_sec": self.refresh_margin_sec,
+                **self.stats,
+            }
+
+
+_prompt_cache = PromptPrefixCache(
+    PROMPT_CACHE_TTL_SEC,
+    PROMPT_CACHE_REFRESH_MARGIN_SEC,
+    PROMPT_CACHE_MAX_ENTRIES,
+    PROMPT_CACHE_FAILURE_BACKOFF_SEC,
+)
+
+
+def prompt_prefix_key(payload: ReviewPayload, model: str, stage: str, static_text: str) -> str:
+    digest = hashlib.sha256(static_text.encode("utf-8")).hexdigest()[:16]
+    sha = (payload.repo_default_branch_sha or "-")[:12]
+    return f"{payload.repo_full_name}@{sha}|{model}|{stage}|{digest}"
+
+
+@traced("build_prompt")
+def build_prompt(
+    client,
+    model: str,
+    stage: str,
+    payload: ReviewPayload,
+    system_instructions: str,
+    dynamic_text: str,
+) -> Tuple[List[types.Content], Optional[str]]:
+    """
+    Lay out a prompt as static prefix (instructions, repo docs) followed by the
+    per-event context. Returns (contents, cached_content_name); when the prefix
+    is served from the provider cache only the dynamic part is sent.
+    """
+    docs_text = build_static_context(payload)
+    static_text = f"{system_instructions}\n\n{docs_text}".strip()
+
+    cached: Optional[str] = None
+    if PROMPT_CACHE_ENABLED and len(static_text) >= PROMPT_CACHE_MIN_CHARS and docs_text:
+        key = prompt_prefix_key(payload, model, stage, static_text)
+        cached = _prompt_cache.resolve(client, model, key, system_instructions, docs_text)
+        if cached and isinstance(client, CredentialPool) and not client.cache_owner_available(cached):
+            cached = None  # owner key is sidelined: this call goes inline, the entry stays
+
+    text = dynamic_text if cached else f"{static_text}\n\n{dynamic_text}"
+    return [types.Content(role="user", parts=[types.Part(text=text)])], cached
+
+
+# ----------------------------
+# Gemini hedging (sync)
+# ----------------------------
+class _StageLatency:
+    """Rolling window of successful primary-call latencies for one stage."""
+
+    def __init__(self, window: int):
+        self.samples: deque = deque(maxlen=max(1, window))
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SEC
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, max(0, math.ceil(HEDGE_PERCENTILE * len(ordered)) - 1))
+        return min(HEDGE_MAX_DELAY_SEC, max(HEDGE_MIN_DELAY_SEC, ordered[idx]))
+
+
+_hedge_lock = threading.Lock()
+_hedge_latency: dict = {}  # stage -> _StageLatency
+_hedge_stats: dict = {}  # stage -> counters
+_hedge_tokens = HEDGE_BUDGET_BURST
+_hedge_pool: Optional[ThreadPoolExecutor] = None
+# One slot per pool worker: calls only go to the pool when a worker is free, so nothing queues there.
+_hedge_slots = threading.BoundedSemaphore(max(1, HEDGE_MAX_WORKERS))
+
+
+def _hedge_stage_stats(stage: str) -> dict:
+    # caller holds _hedge_lock
+    st = _hedge_stats.get(stage)
+    if st is None:
+        st = {
+            "calls": 0,
+            "hedges_fired": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "budget_denied": 0,
+            "pool_saturated": 0,
+            "errors": 0,
+        }
+        _hedge_stats[stage] = st
+    return st
+
+
+def _hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_pool
+    with _hedge_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="gemini-hedge")
+        return _hedge_pool
+
+
+def _submit_hedge_call(fn: Callable[[], T], slots: threading.BoundedSemaphore):
+    """Submit to the hedge pool; caller holds one of `slots`, released when the call ends."""
+    try:
+        fut = _hedge_executor().submit(contextvars.copy_context().run, fn)
+    except BaseException:
+        slots.release()
+        raise
+    fut.add_done_callback(lambda _f: slots.release())
+    return fut
+
+
+def _note_pool_saturated(stage: str) -> None:
+    with _hedge_lock:
+        _hedge_stage_stats(stage)["pool_saturated"] += 1
+
+
+def _add_primary_latency(stage: str, seconds: float) -> None:
+    with _hedge_lock:
+        lat = _hedge_latency.get(stage)
+        if lat is None:
+            lat = _StageLatency(HEDGE_WINDOW)
+            _hedge_latency[stage] = lat
+        lat.add(seconds)
+
+
+def _record_primary_latency(stage: str, started: float, fut) -> None:
+    if fut.cancelled() or fut.exception() is not None:
+        return
+    _add_primary_latency(stage, time.monotonic() - started)
+
+
+def _take_hedge_token(stage: str) -> bool:
+    global _hedge_tokens
+    with _hedge_lock:
+        if _hedge_tokens >= 1.0:
+            _hedge_tokens -= 1.0
+            _hedge_stage_stats(stage)["hedges_fired"] += 1
+            return True
+        _hedge_stage_stats(stage)["budget_denied"] += 1
+        return False
+
+
+def _run_hedged(stage: str, fn: Callable[[], T]) -> T:
+    """
+    Run `fn` and, if it is still pending after the stage's adaptive latency
+    percentile, fire one identical backup call. First successful result wins.
+    Only use for idempotent calls. When every hedge worker is busy the call runs
+    inline, unhedged, rather than queueing (queue time would otherwise fire hedges).
+    """
+    global _hedge_tokens
+    with _hedge_lock:
+        _hedge_stage_stats(stage)["calls"] += 1
+        _hedge_tokens = min(HEDGE_BUDGET_BURST, _hedge_tokens + HEDGE_BUDGET_RATIO)
+        lat = _hedge_latency.get(stage)
+        delay = lat.hedge_delay() if lat else HEDGE_DEFAULT_DELAY_SEC
+
+    slots = _hedge_slots
+    started = time.monotonic()
+    if not slots.acquire(blocking=False):
+        _note_pool_saturated(stage)
+        try:
+            result = fn()
+        except Exception:
+            with _hedge_lock:
+                _hedge_stage_stats(stage)["errors"] += 1
+            raise
+        _add_primary_latency(stage, time.monotonic() - started)
+        with _hedge_lock:
+            _hedge_stage_stats(stage)["primary_wins"] += 1
+        return result
+
+    primary = _submit_hedge_call(fn, slots)
+    primary.add_done_callback(lambda f: _record_primary_latency(stage, started, f))
+
+    done, _ = wait([primary], timeout=delay)
+    hedge = None
+    if not done:
+        if not slots.acquire(blocking=False):
+            _note_pool_saturated(stage)
+        elif not _take_hedge_token(stage):
+            slots.release()
+        else:
+            hedge = _submit_hedge_call(fn, slots)
+
+    if hedge is None:
+        wait([primary])
+        err = primary.exception()
+        with _hedge_lock:
+            _hedge_stage_stats(stage)["errors" if err is not None else "primary_wins"] += 1
+        if err is not None:
+            raise err
+        return primary.result()
+
+    print(f"[gemini] {stage}: no response after {delay:.2f}s, firing hedge", file=sys.stderr)
+    pending = {primary, hedge}
+    first_error: Optional[BaseException] = None
+
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            err = f.exception()
+            if err is not None:
+                first_error = first_error or err
+                continue
+            # Loser cannot be interrupted mid-HTTP call; cancel if not started, otherwise its result is dropped.
+            for other in pending:
+                other.cancel()
+            with _hedge_lock:
+                _hedge_stage_stats(stage)["hedge_wins" if f is hedge else "primary_wins"] += 1
+            return f.result()
+
+    assert first_error is not None
+    with _hedge_lock:
+        _hedge_stage_stats(stage)["errors"] += 1
+    raise first_error
+
+
+def hedging_snapshot() -> dict:
+    with _hedge_lock:
+        stages = {}
+        for stage, st in _hedge_stats.items():
+            lat = _hedge_latency.get(stage)
+            fired = st["hedges_fired"]
+            stages[stage] = {
+                **st,
+                "hedge_win_rate": (st["hedge_wins"] / fired) if fired else 0.0,
+                "current_hedge_delay_sec": round(lat.hedge_delay() if lat else HEDGE_DEFAULT_DELAY_SEC, 3),
+                "latency_samples": len(lat.samples) if lat else 0,
+            }
+        return {
+            "enabled": HEDGE_ENABLED,
+            "percentile": HEDGE_PERCENTILE,
+            "budget_tokens": round(_hedge_tokens, 3),
+            "stages": stages,
+        }
+
+
 # ----------------------------
 # Gemini retry wrapper (sync)
 # ----------------------------
@@ -334,6 +1367,7 @@ def gemini_call_with_retry(
     initial_delay: float = RETRY_INITIAL_DELAY_SEC,
     max_delay: float = RETRY_MAX_DELAY_SEC,
     jitter: float = RETRY_JITTER_SEC,
+    hedge: bool = False,
 ) -> T:
     attempt = 1
     delay = max(0.0, initial_delay)
@@ -341,6 +1375,8 @@ def gemini_call_with_retry(
     while True:
         try:
             print(f"[gemini] {call_name}: attempt {attempt}/{max_attempts}", file=sys.stderr)
+            if hedge and HEDGE_ENABLED:
+                return _run_hedged(call_name, fn)
             return fn()
         except Exception as e:
             transient = _is_transient_gemini_error(e)
@@ -355,7 +1391,7 @@ def gemini_call_with_retry(
             if attempt >= max_attempts:
                 raise
 
-            sleep_for = min(max_delay, delay) + random.uniform(0.0, max(0.0, jitter))
+            sleep_for = _retry_sleep_for(call_name, min(max_delay, delay) + random.uniform(0.0, max(0.0, jitter)))
             print(f"[gemini] {call_name}: sleeping {sleep_for:.2f}s before retry", file=sys.stderr)
             time.sleep(sleep_for)
 
@@ -363,6 +1399,333 @@ def gemini_call_with_retry(
             attempt += 1
 
 
+# ----------------------------
+# Suggestion diff validation
+# ----------------------------
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+RefLine = Tuple[Optional[int], str]  # (line number in PR head, text)
+DiffLine = Tuple[str, str]  # (op: " " | "-" | "+", text)
+
+_suggestion_lock = threading.Lock()
+_suggestion_stats = {
+    "validated": 0,
+    "passed": 0,
+    "fixed_locally": 0,
+    "repair_calls": 0,
+    "repaired": 0,
+    "failed": 0,
+    "skipped": 0,
+    "repair_latency_sec_total": 0.0,
+    "repair_prompt_tokens": 0,
+    "repair_output_tokens": 0,
+}
+
+
+def _bump_suggestion_stat(key: str, amount=1) -> None:
+    with _suggestion_lock:
+        _suggestion_stats[key] += amount
+
+
+def suggestion_validation_snapshot() -> dict:
+    with _suggestion_lock:
+        st = dict(_suggestion_stats)
+    checked = st["validated"]
+    st["pass_rate"] = (st["passed"] / checked) if checked else 0.0
+    st["usable_rate"] = ((st["passed"] + st["fixed_locally"] + st["repaired"]) / checked) if checked else 0.0
+    return st
+
+
+def _patch_head_lines(patch: Optional[str]) -> List[RefLine]:
+    """Lines that exist in the PR head (context + added) with their head line numbers."""
+    out: List[RefLine] = []
+    line_no: Optional[int] = None
+    for raw in (patch or "").splitlines():
+        m = _HUNK_HEADER_RE.match(raw)
+        if m:
+            line_no = int(m.group(3))
+            continue
+        if line_no is None and (raw.startswith("+++ ") or raw.startswith("--- ")):
+            continue
+        if raw.startswith("\\") or raw.startswith("-"):
+            continue
+        if raw.startswith("+") or raw.startswith(" ") or raw == "":
+            out.append((line_no, raw[1:]))
+            if line_no is not None:
+                line_no += 1
+    return out
+
+
+def _reference_segments(payload: ReviewPayload) -> List[Tuple[Optional[str], List[RefLine]]]:
+    """(filename, head lines) per PR patch, plus the comment's own hunk."""
+    files = payload.files or []
+    if payload.comment_path:
+        files = [f for f in files if f.filename == payload.comment_path]
+
+    segments = [(f.filename, _patch_head_lines(f.patch)) for f in files if f.patch]
+    if payload.comment_diff_hunk:
+        segments.append((payload.comment_path, _patch_head_lines(payload.comment_diff_hunk)))
+    return [(name, seg) for name, seg in segments if seg]
+
+
+def _segments_for(path: Optional[str], segments: List[Tuple[Optional[str], List[RefLine]]]) -> List[List[RefLine]]:
+    """Reference lines a hunk may align against: only its own file when the diff names one."""
+    if path is None:
+        return [seg for _, seg in segments]
+    return [seg for name, seg in segments if name is None or _normalize_comment_path(name) == path]
+
+
+class _DiffHunk:
+    def __init__(self, header: Optional[str]):
+        self.header = header  # original "@@ ... @@" line; None for a headerless leading hunk
+        self.raw: List[str] = []  # body exactly as the model wrote it
+        self.lines: List[DiffLine] = []
+        self.fixed: List[DiffLine] = []
+        self.start: Optional[int] = None
+        self.changed = False
+
+
+class _DiffFile:
+    def __init__(self):
+        self.header: List[str] = []  # "diff --git" / "index" / "---" / "+++" lines, kept verbatim
+        self.path: Optional[str] = None
+        self.hunks: List[_DiffHunk] = []
+
+
+_DIFF_FILE_HEADER_PREFIXES = (
+    "diff --git",
+    "index ",
+    "--- ",
+    "+++ ",
+    "new file mode",
+    "deleted file mode",
+    "similarity index",
+    "rename from",
+    "rename to",
+)
+
+
+def _diff_header_path(raw: str) -> Optional[str]:
+    if raw.startswith("diff --git"):
+        parts = raw.split()
+        return _normalize_comment_path(parts[-1]) if len(parts) >= 4 else None
+    path = raw[4:].split("\t")[0].strip()
+    return None if path == "/dev/null" else _normalize_comment_path(path)
+
+
+def _parse_diff_block(block: str) -> Optional[Tuple[str, List[_DiffFile]]]:
+    """Parse a ```diff fenced block into per-file hunks. Returns (fence line, files) or None for non-diff blocks."""
+    lines = block.strip().splitlines()
+    if not lines or not lines[0].startswith("```diff"):
+        return None
+    body = lines[1:-1] if lines[-1].strip() == "```" else lines[1:]
+
+    files: List[_DiffFile] = []
+    cur_file: Optional[_DiffFile] = None
+    hunk: Optional[_DiffHunk] = None
+    for i, raw in enumerate(body):
+        next_raw = body[i + 1] if i + 1 < len(body) else ""
+        starts_file = raw.startswith("diff --git") or (raw.startswith("--- ") and next_raw.startswith("+++ "))
+        if starts_file and (cur_file is None or cur_file.hunks):
+            cur_file = _DiffFile()
+            files.append(cur_file)
+            hunk = None
+        if hunk is None and raw.startswith(_DIFF_FILE_HEADER_PREFIXES):
+            if cur_file is None:
+                cur_file = _DiffFile()
+                files.append(cur_file)
+            cur_file.header.append(raw)
+            if raw.startswith(("diff --git", "--- ", "+++ ")):
+                cur_file.path = _diff_header_path(raw) or cur_file.path
+            continue
+
+        if cur_file is None:
+            cur_file = _DiffFile()
+            files.append(cur_file)
+        if raw.startswith("@@"):
+            hunk = _DiffHunk(raw)
+            cur_file.hunks.append(hunk)
+            continue
+        if hunk is None:
+            hunk = _DiffHunk(None)
+            cur_file.hunks.append(hunk)
+        hunk.raw.append(raw)
+        if raw.startswith("\\"):
+            continue
+        if raw[:1] in ("+", "-", " "):
+            hunk.lines.append((raw[0], raw[1:]))
+        else:
+            hunk.lines.append((" ", raw))  # models often drop the leading space on context lines
+
+    for f in files:
+        f.hunks = [h for h in f.hunks if h.lines]
+    return lines[0], files
+
+
+def _norm_ws(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _align(old_lines: List[str], segments: List[List[RefLine]], loose: bool) -> Optional[Tuple[int, int]]:
+    """Find (segment index, start offset) where old_lines appear contiguously."""
+    key = _norm_ws if loose else (lambda t: t)
+    want = [key(t) for t in old_lines]
+    k = len(want)
+    for si, seg in enumerate(segments):
+        texts = [key(t) for _, t in seg]
+        for i in range(len(texts) - k + 1):
+            if texts[i : i + k] == want:
+                return si, i
+    return None
+
+
+def _fix_hunk(hunk: List[DiffLine], segments: List[List[RefLine]]) -> Optional[Tuple[List[DiffLine], Optional[int], bool]]:
+    """
+    Try to make a hunk's context/removed lines match the PR head exactly.
+    Returns (hunk, head start line, changed) or None if it cannot be aligned locally.
+    """
+    candidates = [(hunk, False)]
+    trimmed = list(hunk)
+    while trimmed and trimmed[0][0] == " ":
+        trimmed.pop(0)
+    while trimmed and trimmed[-1][0] == " ":
+        trimmed.pop()
+    if trimmed != hunk and any(op == "-" for op, _ in trimmed):
+        candidates.append((trimmed, True))
+
+    for cand, was_trimmed in candidates:
+        old = [t for op, t in cand if op != "+"]
+        if not old:
+            return cand, None, was_trimmed
+        for loose in (False, True):
+            hit = _align(old, segments, loose)
+            if hit is None:
+                continue
+            si, start = hit
+            ref = segments[si][start : start + len(old)]
+            fixed: List[DiffLine] = []
+            it = iter(ref)
+            for op, t in cand:
+                fixed.append((op, t) if op == "+" else (op, next(it)[1]))
+            if loose:
+                fixed = _reindent_added(cand, fixed)
+                if fixed is None:
+                    continue
+            return fixed, ref[0][0], was_trimmed or fixed != cand
+    return None
+
+
+def _indent(text: str) -> str:
+    return text[: len(text) - len(text.lstrip())]
+
+
+def _reindent_added(original: List[DiffLine], fixed: List[DiffLine]) -> Optional[List[DiffLine]]:
+    """
+    After a whitespace-loose match rewrote context/removed lines to the file's
+    indentation, shift the added lines by the same indent delta. Removed lines
+    carry an explicit prefix, so they decide the delta when present.
+    Returns None when the delta is inconsistent or can't be applied.
+    """
+    pairs = [(op, a, b) for (op, a), (_, b) in zip(original, fixed) if op != "+" and a.strip()]
+    basis = [p for p in pairs if p[0] == "-"] or pairs
+
+    deltas = set()
+    for _, model_text, file_text in basis:
+        mi, fi = _indent(model_text), _indent(file_text)
+        if fi.endswith(mi):
+            deltas.add(("add", fi[: len(fi) - len(mi)]))
+        elif mi.endswith(fi):
+            deltas.add(("strip", mi[: len(mi) - len(fi)]))
+        else:
+            return None
+    deltas = {("add", "") if d[1] == "" else d for d in deltas}
+    if len(deltas) > 1:
+        return None
+    mode, extra = deltas.pop() if deltas else ("add", "")
+
+    out: List[DiffLine] = []
+    for op, t in fixed:
+        if op != "+" or not t.strip() or not extra:
+            out.append((op, t))
+        elif mode == "add":
+            out.append((op, extra + t))
+        elif t.startswith(extra):
+            out.append((op, t[len(extra) :]))
+        else:
+            return None
+    return out
+
+
+def _render_diff_block(fence: str, files: List[_DiffFile]) -> str:
+    """Re-emit the diff with its file headers; unchanged hunks keep their original lines."""
+    out = [fence]
+    for f in files:
+        out.extend(f.header)
+        delta = 0  # line shift from earlier hunks of the same file
+        for h in f.hunks:
+            old_n = sum(1 for op, _ in h.fixed if op != "+")
+            new_n = sum(1 for op, _ in h.fixed if op != "-")
+            if h.start is not None:
+                m = _HUNK_HEADER_RE.match(h.header or "")
+                section = (h.header or "")[m.end() :] if m else ""
+                out.append(f"@@ -{h.start},{old_n} +{h.start + delta},{new_n} @@{section}")
+            elif h.header is not None:
+                out.append(h.header)
+            delta += new_n - old_n
+            if h.changed:
+                out.extend(f"{op}{t}" for op, t in h.fixed)
+            else:
+                out.extend(h.raw)
+    out.append("```")
+    return "\n".join(out)
+
+
+def validate_suggestion_locally(payload: ReviewPayload, block: str) -> Tuple[str, str]:
+    """
+    Check a ```diff suggestion against the PR patch / comment hunk.
+    Returns (status, block) where status is "passed" | "fixed_locally" | "failed" | "skipped".
+    """
+    parsed = _parse_diff_block(block)
+    segments = _reference_segments(payload)
+    if not parsed or not segments:
+        return "skipped", block
+    fence, files = parsed
+    if not any(op != "+" for f in files for h in f.hunks for op, _ in h.lines):
+        return "skipped", block
+
+    changed = False
+    for f in files:
+        own = _segments_for(f.path, segments)
+        for h in f.hunks:
+            res = _fix_hunk(h.lines, own)
+            if res is None:
+                return "failed", block
+            h.fixed, h.start, h.changed = res
+            changed = changed or h.changed
+
+    rendered = _render_diff_block(fence, files)
+    if not changed:
+        # Lines matched as-is; only the @@ numbers may differ from the model's block.
+        return "passed", rendered
+    return "fixed_locally", rendered
+
+
+def _repair_reference_excerpt(payload: ReviewPayload, block: str) -> str:
+    """Pick the reference window that shares the most lines with the suggestion."""
+    _, files = _parse_diff_block(block) or ("", [])
+    wanted = {_norm_ws(t) for f in files for h in f.hunks for op, t in h.lines if op != "+" and t.strip()}
+    best: List[RefLine] = []
+    best_score = -1
+    n = max(1, SUGGESTION_REPAIR_REF_LINES)
+    for _, seg in _reference_segments(payload):
+        for i in range(0, max(1, len(seg) - n + 1), max(1, n // 4)):
+            window = seg[i : i + n]
+            score = sum(1 for _, t in window if _norm_ws(t) in wanted)
+            if score > best_score:
+                best, best_score = window, score
+    return "\n".join(f"{ln if ln is not None else '?'}: {t}" for ln, t in best)
+
+
 # ----------------------------
 # Gemini calls (sync)
 # ----------------------------
@@ -392,28 +1755,23 @@ Return ONLY valid JSON for the schema.
     ctx = build_llm_context(payload)
 
     def _call():
-        resp = client.models.generate_content(
+        contents, cached = build_prompt(client, model, "classify_with_gemini", payload, system_instructions, f"CONTEXT:\n{ctx}")
+        resp = gemini_generate(
+            client,
+            "classify_with_gemini",
             model=model,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[types.Part(text=f"{system_instructions}\n\nCONTEXT:\n{ctx}")],
-                )
-            ],
+            contents=contents,
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
                 response_schema=Classification,
                 temperature=0.2,
+                cached_content=cached,
             ),
         )
 
-        data = getattr(resp, "parsed", None)
-        if data is None:
-            data = json.loads(resp.text)
+        return parse_structured(resp, Classification)
 
-        return Classification.model_validate(data)
-
-    return gemini_call_with_retry("classify_with_gemini", _call)
+    return gemini_call_with_retry("classify_with_gemini", _call, hedge=True)
 
 
 def clarify_bad_question(payload: ReviewPayload, cls: Classification) -> ClarifiedQuestion:
@@ -435,28 +1793,23 @@ Rules:
     ctx = build_llm_context(payload)
 
     def _call():
-        resp = client.models.generate_content(
+        contents, cached = build_prompt(client, model, "clarify_bad_question", payload, system_instructions, f"CONTEXT:\n{ctx}")
+        resp = gemini_generate(
+            client,
+            "clarify_bad_question",
             model=model,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[types.Part(text=f"{system_instructions}\n\nCONTEXT:\n{ctx}")],
-                )
-            ],
+            contents=contents,
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
                 response_schema=ClarifiedQuestion,
                 temperature=0.2,
+                cached_content=cached,
             ),
         )
 
-        data = getattr(resp, "parsed", None)
-        if data is None:
-            data = json.loads(resp.text)
-
-        return ClarifiedQuestion.model_validate(data)
+        return parse_structured(resp, ClarifiedQuestion)
 
-    return gemini_call_with_retry("clarify_bad_question", _call)
+    return gemini_call_with_retry("clarify_bad_question", _call, hedge=True)
 
 
 def clarify_bad_change(payload: ReviewPayload, cls: Classification) -> ClarifiedChange:
@@ -478,28 +1831,23 @@ Rules:
     ctx = build_llm_context(payload)
 
     def _call():
-        resp = client.models.generate_content(
+        contents, cached = build_prompt(client, model, "clarify_bad_change", payload, system_instructions, f"CONTEXT:\n{ctx}")
+        resp = gemini_generate(
+            client,
+            "clarify_bad_change",
             model=model,
-            contents=[
-                types.Content(
-                    role="user",
-                    parts=[types.Part(text=f"{system_instructions}\n\nCONTEXT:\n{ctx}")],
-                )
-            ],
+            contents=contents,
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
                 response_schema=ClarifiedChange,
                 temperature=0.2,
+                cached_content=cached,
             ),
         )
 
-        data = getattr(resp, "parsed", None)
-        if data is None:
-            data = json.loads(resp.text)
-
-        return ClarifiedChange.model_validate(data)
+        return parse_structured(resp, ClarifiedChange)
 
-    return gemini_call_with_retry("clarify_bad_change", _call)
+    return gemini_call_with_retry("clarify_bad_change", _call, hedge=True)
 
 
 def generate_code_suggestion(
@@ -513,7 +1861,7 @@ def generate_code_suggestion(
     reviewer_comment = (reviewer_comment_override or payload.comment_body or payload.review_body or "").strip()
     ctx = build_llm_context(payload)
 
-    system_instructions = f"""
+    system_instructions = """
 You are a GitHub code review assistant.
 
 Goal: produce a SHORT, STRICT code suggestion for the requested change.
@@ -526,14 +1874,12 @@ Hard rules:
 - Keep it minimal: change ONLY the smallest relevant lines.
 - Do NOT rewrite whole files. Do NOT include unrelated context.
 - If unsure, output a SMALL diff that adds TODOs/placeholders rather than guessing.
-- If project conventions/style guides are included in CONTEXT, follow them.
+- If project conventions/style guides are included below, follow them.
+""".strip()
 
+    dynamic = f"""
 Comment to satisfy (source of truth):
 {reviewer_comment}
-""".strip()
-
-    prompt = f"""
-{system_instructions}
 
 CONTEXT (reference only):
 ---
@@ -544,14 +1890,87 @@ Return ONLY the single fenced code block now.
 """.strip()
 
     def _call():
-        resp = client.models.generate_content(
+        contents, cached = build_prompt(client, model, "generate_code_suggestion", payload, system_instructions, dynamic)
+        resp = gemini_generate(
+            client,
+            "generate_code_suggestion",
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(temperature=0.2, cached_content=cached),
+        )
+        return extract_first_fenced_code_block((resp.text or "").strip())
+
+    block = gemini_call_with_retry("generate_code_suggestion", _call)
+    if not SUGGESTION_VALIDATE:
+        return block
+    return validate_and_repair_suggestion(payload, block)
+
+
+def repair_code_suggestion(payload: ReviewPayload, block: str) -> str:
+    """One small targeted repair call: fix context/removed lines only, never regenerate."""
+    client = get_client()
+    model = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+    reference = _repair_reference_excerpt(payload, block)
+
+    prompt = f"""
+The ```diff below does not apply: some context (' ') or removed ('-') lines do not match
+the current file. Rewrite ONLY those lines so they match ACTUAL LINES exactly (same text,
+same whitespace). Keep the added ('+') lines and the intent of the change unchanged.
+Output ONLY one ```diff fenced code block and NOTHING else.
+
+ACTUAL LINES (line: text):
+{reference}
+
+DIFF TO FIX:
+{block}
+""".strip()
+
+    def _call():
+        started = time.monotonic()
+        resp = gemini_generate(
+            client,
+            "repair_code_suggestion",
             model=model,
             contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
-            config=types.GenerateContentConfig(temperature=0.2),
+            config=types.GenerateContentConfig(temperature=0.0),
         )
+        _bump_suggestion_stat("repair_latency_sec_total", time.monotonic() - started)
+        usage = getattr(resp, "usage_metadata", None)
+        if usage is not None:
+            _bump_suggestion_stat("repair_prompt_tokens", getattr(usage, "prompt_token_count", None) or 0)
+            _bump_suggestion_stat("repair_output_tokens", getattr(usage, "candidates_token_count", None) or 0)
         return extract_first_fenced_code_block((resp.text or "").strip())
 
-    return gemini_call_with_retry("generate_code_suggestion", _call)
+    return gemini_call_with_retry("repair_code_suggestion", _call, max_attempts=SUGGESTION_REPAIR_MAX_ATTEMPTS)
+
+
+def validate_and_repair_suggestion(payload: ReviewPayload, block: str) -> str:
+    status, out = validate_suggestion_locally(payload, block)
+    if status == "skipped":
+        _bump_suggestion_stat("skipped")
+        return block
+
+    _bump_suggestion_stat("validated")
+    if status in ("passed", "fixed_locally"):
+        _bump_suggestion_stat(status)
+        return out
+
+    print("[suggestion] diff does not match PR patch; attempting targeted repair", file=sys.stderr)
+    _bump_suggestion_stat("repair_calls")
+    try:
+        repaired = repair_code_suggestion(payload, block)
+    except Exception as e:
+        print(f"[suggestion] repair failed: {type(e).__name__}: {str(e)[:180]}", file=sys.stderr)
+        _bump_suggestion_stat("failed")
+        return block
+
+    status, out = validate_suggestion_locally(payload, repaired)
+    if status in ("passed", "fixed_locally"):
+        _bump_suggestion_stat("repaired")
+        return out
+
+    _bump_suggestion_stat("failed")
+    return block
 
 
 def generate_pr_discussion_reply(payload: ReviewPayload) -> str:
@@ -573,17 +1992,20 @@ Return ONLY valid JSON for the schema.
 """.strip()
 
     def _call():
-        resp = client.models.generate_content(
+        contents, cached = build_prompt(client, model, "generate_pr_discussion_reply", payload, system_instructions, f"CONTEXT:\n{ctx}")
+        resp = gemini_generate(
+            client,
+            "generate_pr_discussion_reply",
             model=model,
-            contents=[types.Content(role="user", parts=[types.Part(text=f"{system_instructions}\n\nCONTEXT:\n{ctx}")])],
+            contents=contents,
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
                 response_schema=DiscussionReply,
                 temperature=0.3,
+                cached_content=cached,
             ),
         )
-        data = getattr(resp, "parsed", None) or json.loads(resp.text)
-        out = DiscussionReply.model_validate(data)
+        out = parse_structured(resp, DiscussionReply)
 
         if not out.needs_reply:
             return ""
@@ -596,7 +2018,7 @@ Return ONLY valid JSON for the schema.
     return gemini_call_with_retry("generate_pr_discussion_reply", _call)
 
 
-def run_wizard_candidate_comments(payload: ReviewPayload) -> str:
+def review_wizard_candidates(payload: ReviewPayload) -> List[CandidateReviewComment]:
     client = get_client()
     model = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
     ctx = build_llm_context(payload)
@@ -618,33 +2040,21 @@ Rules:
 """.strip()
 
     def _call():
-        resp = client.models.generate_content(
+        contents, cached = build_prompt(client, model, "wizard_review_candidates", payload, system_instructions, f"CONTEXT:\n{ctx}")
+        resp = gemini_generate(
+            client,
+            "wizard_review_candidates",
             model=model,
-            contents=[types.Content(role="user", parts=[types.Part(text=f"{system_instructions}\n\nCONTEXT:\n{ctx}")])],
+            contents=contents,
             config=types.GenerateContentConfig(
                 response_mime_type="application/json",
                 response_schema=CandidateReviewOutput,
                 temperature=0.3,
+                cached_content=cached,
             ),
         )
-        data = getattr(resp, "parsed", None) or json.loads(resp.text)
-        out = CandidateReviewOutput.model_validate(data)
-
-        if not out.comments:
-            return "_No significant issues found in the provided diff context._"
-
-        lines: List[str] = []
-        for i, c in enumerate(out.comments[:8], start=1):
-            lines.append(f"### {i}) {c.title.strip()}")
-            if c.file_path:
-                lines.append(f"**File:** `{c.file_path}`")
-            lines.append(f"**Description:** {c.description.strip()}")
-            if c.reference_urls:
-                lines.append("**References:**")
-                for u in c.reference_urls[:3]:
-                    lines.append(f"- {u}")
-            lines.append("")
-        return "\n".join(lines).strip()
+        out = parse_structured(resp, CandidateReviewOutput)
+        return out.comments[:8]
 
     return gemini_call_with_retry("wizard_review_candidates", _call)
 
@@ -652,6 +2062,24 @@ Rules:
 # ----------------------------
 # Formatting helpers
 # ----------------------------
+def format_candidate_comments(comments: List[CandidateReviewComment], limit: int = 8) -> str:
+    if not comments:
+        return "_No significant issues found in the provided diff context._"
+
+    lines: List[str] = []
+    for i, c in enumerate(comments[:limit], start=1):
+        lines.append(f"### {i}) {c.title.strip()}")
+        if c.file_path:
+            lines.append(f"**File:** `{c.file_path}`")
+        lines.append(f"**Description:** {c.description.strip()}")
+        if c.reference_urls:
+            lines.append("**References:**")
+            for u in c.reference_urls[:3]:
+                lines.append(f"- {u}")
+        lines.append("")
+    return "\n".join(lines).strip()
+
+
 def format_debug_comment(payload: ReviewPayload, cls: Classification) -> str:
     where = "review" if payload.kind == "review" else "inline comment"
     original_text = payload.review_body if payload.kind == "review" else payload.comment_body
@@ -719,17 +2147,353 @@ def format_bad_change_with_suggestion_comment(
     return out
 
 
+# ----------------------------
+# Wizard review memory (incremental /wizard-review)
+# ----------------------------
+# (repo_full_name, pr_number) -> {"files": {filename: {"patch_hash", "comments"}}, "general": [comments]}
+_wizard_memory: OrderedDict = OrderedDict()
+_wizard_memory_lock = threading.Lock()
+
+
+def _file_patch_hash(f: FileInfo) -> str:
+    raw = f"{f.status}\0{f.patch if f.patch is not None else f'<no patch> changes={f.changes}'}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _normalize_comment_path(path: Optional[str]) -> str:
+    p = (path or "").strip().strip("`")
+    for prefix in ("./", "a/", "b/"):
+        if p.startswith(prefix):
+            p = p[len(prefix) :]
+    return p
+
+
+def _is_bare_wizard_command(payload: ReviewPayload) -> bool:
+    return (payload.comment_body or payload.review_body or "").strip() == "/wizard-review"
+
+
+def remember_wizard_review(
+    payload: ReviewPayload,
+    comments: List[CandidateReviewComment],
+    reviewed_files: Optional[List[FileInfo]] = None,
+    kept: Optional[dict] = None,
+) -> None:
+    """
+    Store comments bucketed by file with the patch hash they were produced for.
+    `reviewed_files` defaults to the PR files whose patches fit in the model context (files past
+    the cap stay unrecorded so the next run reviews them); `kept` carries forward unchanged files.
+    """
+    if reviewed_files is None:
+        reviewed_files = (payload.files or [])[:LLM_CONTEXT_MAX_PATCHES]
+    reviewed = reviewed_files
+    files = dict(kept or {})
+    for f in reviewed:
+        files[f.filename] = {"patch_hash": _file_patch_hash(f), "comments": []}
+
+    general: List[CandidateReviewComment] = []
+    for c in comments:
+        path = _normalize_comment_path(c.file_path)
+        if path in files and any(f.filename == path for f in reviewed):
+            files[path]["comments"].append(c)
+        else:
+            general.append(c)
+
+    key = (payload.repo_full_name, payload.pr_number)
+    with _wizard_memory_lock:
+        _wizard_memory[key] = {"files": files, "general": general}
+        _wizard_memory.move_to_end(key)
+        while len(_wizard_memory) > WIZARD_MEMORY_MAX_PRS:
+            _wizard_memory.popitem(last=False)
+
+
+def run_incremental_wizard_review(payload: ReviewPayload) -> str:
+    """
+    Re-review only files whose patch changed since the last /wizard-review on this PR;
+    reuse earlier comments for unchanged files and drop comments on changed/removed files.
+    """
+    key = (payload.repo_full_name, payload.pr_number)
+    with _wizard_memory_lock:
+        memory = _wizard_memory.get(key)
+
+    current = payload.files or []
+    bare = _is_bare_wizard_command(payload)
+    if memory is None or not current or not bare:
+        comments = review_wizard_candidates(payload)
+        if bare:
+            # Extra instructions narrow the review; only a full one may seed later incremental runs.
+            remember_wizard_review(payload, comments)
+        return format_candidate_comments(comments)
+
+    prev_files = memory["files"]
+    changed: List[FileInfo] = []
+    kept: dict = {}
+    for f in current:
+        prev = prev_files.get(f.filename)
+        if prev is not None and prev["patch_hash"] == _file_patch_hash(f):
+            kept[f.filename] = prev
+        else:
+            changed.append(f)
+
+    reused = [c for entry in kept.values() for c in entry["comments"]]
+    dropped = sum(len(e["comments"]) for name, e in prev_files.items() if name not in kept)
+
+    # Only the patches that fit in the context count as reviewed; the rest wait for the next run.
+    reviewed = changed[:LLM_CONTEXT_MAX_PATCHES]
+    deferred = len(changed) - len(reviewed)
+
+    if changed:
+        fresh = review_wizard_candidates(payload.model_copy(update={"files": changed}))
+        remember_wizard_review(payload, fresh, reviewed_files=reviewed, kept=kept)
+        general_dropped = len(memory["general"])
+    else:
+        # Nothing changed: answer entirely from memory, keep the earlier PR-level comments too.
+        fresh = list(memory["general"])
+        remember_wizard_review(payload, fresh, reviewed_files=[], kept=kept)
+        general_dropped = 0
+
+    merged = reused + fresh
+    body = format_candidate_comments(merged, limit=WIZARD_MERGED_MAX_COMMENTS)
+
+    note = (
+        f"_♻️ Incremental re-review: re-reviewed {len(reviewed)} changed file(s), "
+        f"reused {len(reused)} earlier comment(s) on {len(kept)} unchanged file(s)"
+    )
+    if deferred:
+        note += f", left {deferred} more changed file(s) for the next run (context limit)"
+    if dropped + general_dropped:
+        note += f", dropped {dropped + general_dropped} earlier comment(s) superseded by this re-review"
+    note += "._"
+    return f"{body}\n\n{note}"
+
+
+# ----------------------------
+# PR precompute (/prepare-pr)
+# ----------------------------
+# (repo_full_name, pr_number) -> {"head_sha", "created_at", "task"}; only touched from the event loop.
+_prepared: OrderedDict = OrderedDict()
+_prepared_stats = {"scheduled": 0, "hits": 0, "misses": 0, "stale_evictions": 0, "failures": 0}
+# Caps background precomputes so a burst of pushes can't crowd live requests out of the thread pool.
+_prepare_semaphore = asyncio.Semaphore(max(1, PREPARE_MAX_CONCURRENCY))
+
+
+def _prepared_key(payload: ReviewPayload) -> Tuple[str, int]:
+    return payload.repo_full_name, payload.pr_number
+
+
+def _evict_prepared(key: Tuple[str, int], reason: str) -> None:
+    entry = _prepared.pop(key, None)
+    if entry is None:
+        return
+    if reason == "stale":
+        _prepared_stats["stale_evictions"] += 1
+    if not entry["task"].done():
+        entry["task"].cancel()  # stops waiting; a model call already in a worker thread still finishes
+
+
+async def _precompute_pr(payload: ReviewPayload) -> dict:
+    # Runs the same incremental review a live /wizard-review would (and updates the wizard memory),
+    # so only files changed since the last review of this PR go to the model.
+    # Collect model responses so a capture of the /wizard-review this answers stays replayable.
+    cap = {"model_calls": []}
+    if _capture_writer is not None:
+        _capture_ctx.set(cap)
+    async with _prepare_semaphore:
+        review = await run_in_thread("prepare.wizard_review", run_incremental_wizard_review, payload)
+    return {"review": review, "model_calls": cap["model_calls"]}
+
+
+def _log_precompute_result(key: Tuple[str, int], task: asyncio.Task) -> None:
+    failed = task.cancelled() or task.exception() is not None
+    if not failed:
+        return
+    entry = _prepared.get(key)
+    if entry is not None and entry["task"] is task:
+        _prepared.pop(key, None)  # let a redelivered /prepare-pr schedule fresh work
+    if not task.cancelled():
+        err = task.exception()
+        _prepared_stats["failures"] += 1
+        print(f"[prepare] {key[0]}#{key[1]} failed: {type(err).__name__}: {str(err)[:180]}", file=sys.stderr)
+
+
+def schedule_prepare(payload: ReviewPayload) -> PrepareResponse:
+    key = _prepared_key(payload)
+    entry = _prepared.get(key)
+    if entry is not None:
+        task = entry["task"]
+        usable = not task.done() or (not task.cancelled() and task.exception() is None)
+        if (
+            usable
+            and entry["head_sha"] == payload.pr_head_sha
+            and time.monotonic() - entry["created_at"] < PREPARE_CACHE_TTL_SEC
+        ):
+            status = "in_progress" if not task.done() else "cached"
+            return PrepareResponse(status=status, head_sha=payload.pr_head_sha)
+        _evict_prepared(key, "stale" if usable else "failed")
+
+    # Precompute exactly what a bare "/wizard-review" command would ask for.
+    prepared_payload = payload.model_copy(
+        update={"kind": "wizard_review_command", "comment_body": "/wizard-review", "review_body": None}
+    )
+    task = asyncio.get_running_loop().create_task(_precompute_pr(prepared_payload))
+    task.add_done_callback(lambda t: _log_precompute_result(key, t))
+
+    _prepared[key] = {"head_sha": payload.pr_head_sha, "created_at": time.monotonic(), "task": task}
+    _prepared.move_to_end(key)
+    while len(_prepared) > PREPARE_CACHE_MAX_ENTRIES:
+        _evict_prepared(next(iter(_prepared)), "capacity")
+
+    _prepared_stats["scheduled"] += 1
+    return PrepareResponse(status="scheduled", head_sha=payload.pr_head_sha)
+
+
+async def prepared_wizard_review(payload: ReviewPayload) -> Optional[str]:
+    """Serve a bare /wizard-review for the prepared head SHA; None means compute it live."""
+    key = _prepared_key(payload)
+    entry = _prepared.get(key)
+    command = (payload.comment_body or payload.review_body or "").strip()
+
+    if entry is None or not payload.pr_head_sha:
+        _prepared_stats["misses"] += 1
+        return None
+    if entry["head_sha"] != payload.pr_head_sha:
+        # Either side may be newer; /prepare-pr evicts on head moves, so just compute live here.
+        _prepared_stats["misses"] += 1
+        return None
+    if time.monotonic() - entry["created_at"] >= PREPARE_CACHE_TTL_SEC:
+        _evict_prepared(key, "expired")
+        _prepared_stats["misses"] += 1
+        return None
+    if command != "/wizard-review":
+        # Extra instructions in the command change the prompt; don't answer them from the generic review.
+        _prepared_stats["misses"] += 1
+        return None
+
+    try:
+        result = await asyncio.shield(entry["task"])
+    except asyncio.CancelledError:
+        if not entry["task"].cancelled():
+            raise  # this request itself was cancelled
+        _prepared_stats["misses"] += 1
+        return None
+    except Exception:
+        if _prepared.get(key) is entry:
+            _evict_prepared(key, "failed")
+        _prepared_stats["misses"] += 1
+        return None
+
+    _prepared_stats["hits"] += 1
+    if _prepared.get(key) is entry:
+        # Single use: a repeat command must reach the incremental path (e.g. for files the precompute deferred).
+        _evict_prepared(key, "served")
+    cap = _capture_ctx.get()
+    if cap is not None:
+        cap["model_calls"].extend(result["model_calls"])
+        cap["served_from_prepare"] = True
+    return result["review"]
+
+
+def prepared_snapshot() -> dict:
+    return {
+        "entries": len(_prepared),
+        "in_progress": sum(1 for e in _prepared.values() if not e["task"].done()),
+        **_prepared_stats,
+    }
+
+
 # ----------------------------
 # FastAPI route
 # ----------------------------
+@app.middleware("http")
+async def request_trace_middleware(request: Request, call_next):
+    if request.url.path != "/analyze-review" or not request.headers.get(TRACE_HEADER) or not is_admin_request(request):
+        return await call_next(request)
+
+    trace = RequestTrace()
+    _trace_ctx.set(trace)
+    response = await call_next(request)
+    trace.add("total", trace.t0, time.perf_counter())
+    response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@app.post("/admin/profile", response_class=PlainTextResponse)
+async def admin_profile(request: Request, seconds: float = 10.0, hz: int = 100):
+    require_admin(request)
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    hz = max(1, min(hz, PROFILE_MAX_HZ))
+
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    try:
+        collapsed = await anyio.to_thread.run_sync(sample_collapsed_stacks, seconds, hz)
+    finally:
+        _profile_lock.release()
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": "attachment; filename=profile.collapsed"})
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "hedging": hedging_snapshot(),
+        "suggestion_validation": suggestion_validation_snapshot(),
+        "prompt_cache": _prompt_cache.snapshot(),
+        "prepared_reviews": prepared_snapshot(),
+        "credentials": credentials_snapshot(),
+    }
+
+
+@app.post("/prepare-pr", response_model=PrepareResponse)
+async def prepare_pr(payload: ReviewPayload):
+    if not payload.pr_head_sha:
+        return PrepareResponse(status="skipped")
+    print(f"Preparing PR #{payload.pr_number} @ {payload.pr_head_sha[:12]}", file=sys.stderr)
+    return schedule_prepare(payload)
+
+
 @app.post("/analyze-review", response_model=BackendResponse)
-async def analyze_review(payload: ReviewPayload):
+async def analyze_review(payload: ReviewPayload, request: Request):
+    trace = _trace_ctx.get()
+    if trace is not None:
+        # Time between middleware entry and handler entry: body read + pydantic validation.
+        trace.add("request_parse_validate", trace.t0, time.perf_counter())
+
+    replay_id = request.headers.get(REPLAY_ID_HEADER)
+    if REPLAY_FROM and replay_id:
+        _replay_id_ctx.set(replay_id)
+
+    if _capture_writer is None:
+        return await _analyze_review(payload)
+
+    cap = {"model_calls": []}
+    _capture_ctx.set(cap)
+    received_at = time.time()
+    started = time.monotonic()
+    resp = await _analyze_review(payload)
+    record = {
+        "capture_id": uuid.uuid4().hex,
+        "received_at": round(received_at, 4),
+        "duration_sec": round(time.monotonic() - started, 4),
+        "payload": sanitize_for_capture(payload.model_dump()),
+        "model_calls": cap["model_calls"],
+        "served_from_prepare": cap.get("served_from_prepare", False),
+        "response_comment": _redact_text(resp.comment),
+    }
+    try:
+        await anyio.to_thread.run_sync(_capture_writer.write, record)
+    except Exception as e:
+        print(f"[capture] failed to write record: {type(e).__name__}: {e}", file=sys.stderr)
+    return resp
+
+
+async def _analyze_review(payload: ReviewPayload) -> BackendResponse:
     print(f"Processing kind: {payload.kind} for PR #{payload.pr_number}", file=sys.stderr)
 
     # 0) Wizard command: generate candidate review comments (FR5.2)
     if payload.kind == "wizard_review_command":
         try:
-            suggestions = await anyio.to_thread.run_sync(run_wizard_candidate_comments, payload)
+            suggestions = await prepared_wizard_review(payload)
+            if suggestions is None:
+                suggestions = await run_in_thread("wizard_review", run_incremental_wizard_review, payload)
             return BackendResponse(comment=f"🧙‍♂️ **Wizard Candidate Review Comments**\n\n{suggestions}")
         except Exception as e:
             return BackendResponse(comment=f"❌ Error during Wizard Review: {str(e)[:180]}")
@@ -737,22 +2501,23 @@ async def analyze_review(payload: ReviewPayload):
     # 0b) Normal PR discussion comments should be replied to WITHOUT reviewing
     if payload.kind == "issue_comment":
         try:
-            reply_md = await anyio.to_thread.run_sync(generate_pr_discussion_reply, payload)
+            reply_md = await run_in_thread("discussion_reply", generate_pr_discussion_reply, payload)
             return BackendResponse(comment=reply_md)
         except Exception as e:
             return BackendResponse(comment=f"❌ Error generating discussion reply: {type(e).__name__}: {str(e)[:180]}")
 
-    print("==== Incoming payload ====", file=sys.stderr)
-    try:
-        print(json.dumps(payload.model_dump(), indent=2), file=sys.stderr)
-    except Exception:
-        print(json.dumps(payload.dict(), indent=2), file=sys.stderr)
-    print("==========================", file=sys.stderr)
+    with trace_span("debug_payload_dump"):
+        print("==== Incoming payload ====", file=sys.stderr)
+        try:
+            print(json.dumps(payload.model_dump(), indent=2), file=sys.stderr)
+        except Exception:
+            print(json.dumps(payload.dict(), indent=2), file=sys.stderr)
+        print("==========================", file=sys.stderr)
 
     # 1) Classify (only for review/review_comment)
     print("Classifying with Gemini...", file=sys.stderr)
     try:
-        cls = await anyio.to_thread.run_sync(classify_with_gemini, payload)
+        cls = await run_in_thread("classify", classify_with_gemini, payload)
     except Exception as e:
         cls = Classification(
             category="UNKNOWN",
@@ -770,7 +2535,7 @@ async def analyze_review(payload: ReviewPayload):
     if cls.category == "GOOD_CHANGE" and cls.confidence >= 0.7:
         print("Generating good change with Gemini...", file=sys.stderr)
         try:
-            suggestion_block = await anyio.to_thread.run_sync(generate_code_suggestion, payload, cls, None)
+            suggestion_block = await run_in_thread("suggestion", generate_code_suggestion, payload, cls, None)
             return BackendResponse(comment=suggestion_block)
         except Exception as e:
             fallback = Classification(
@@ -786,7 +2551,7 @@ async def analyze_review(payload: ReviewPayload):
     if cls.category == "BAD_QUESTION" and cls.confidence >= 0.55:
         print("Clarifying bad question with Gemini...", file=sys.stderr)
         try:
-            cq = await anyio.to_thread.run_sync(clarify_bad_question, payload, cls)
+            cq = await run_in_thread("clarify_question", clarify_bad_question, payload, cls)
             return BackendResponse(comment=format_clarification_question_comment(payload, cls, cq))
         except Exception as e:
             fallback = Classification(
@@ -802,8 +2567,9 @@ async def analyze_review(payload: ReviewPayload):
     if cls.category == "BAD_CHANGE" and cls.confidence >= 0.55:
         print("Clarifying bad change and generating suggestion with Gemini...", file=sys.stderr)
         try:
-            cc = await anyio.to_thread.run_sync(clarify_bad_change, payload, cls)
-            suggestion_block = await anyio.to_thread.run_sync(
+            cc = await run_in_thread("clarify_change", clarify_bad_change, payload, cls)
+            suggestion_block = await run_in_thread(
+                "suggestion",
                 generate_code_suggestion,
                 payload,
                 cls,
@@ -0,0 +1,183 @@
+# backend/replay.py
+"""
+Re-drive captured /analyze-review traffic against a running backend.
+
+Capture:  run the backend with CONTEXTWIZARD_CAPTURE_DIR=captures/
+Replay:   run the backend with GEMINI_REPLAY_FROM=captures/ (recorded model responses)
+          python replay.py captures/ --speed 4 --out run-b.jsonl --compare run-a.jsonl
+
+Stdlib only; main.py reuses load_capture_records for GEMINI_REPLAY_FROM.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+REPLAY_ID_HEADER = "X-ContextWizard-Capture-Id"
+
+
+def load_capture_records(path: str) -> List[dict]:
+    """Read capture records from a JSONL file or every capture-*.jsonl in a directory, oldest first."""
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, f) for f in os.listdir(path) if f.startswith("capture-") and f.endswith(".jsonl")
+        )
+    else:
+        files = [path]
+
+    records: List[dict] = []
+    for fp in files:
+        with open(fp, encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r.get("received_at", 0.0))
+    return records
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))
+    return ordered[idx]
+
+
+def send_one(url: str, record: dict, timeout: float) -> dict:
+    body = json.dumps(record["payload"]).encode("utf-8")
+    req = urllib.request.Request(
+        url,
+        data=body,
+        method="POST",
+        headers={"Content-Type": "application/json", REPLAY_ID_HEADER: record["capture_id"]},
+    )
+
+    started = time.monotonic()
+    status = 0
+    comment: Optional[str] = None
+    error: Optional[str] = None
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            status = resp.status
+            comment = json.loads(resp.read().decode("utf-8")).get("comment")
+    except urllib.error.HTTPError as e:
+        status = e.code
+        error = f"HTTP {e.code}"
+    except Exception as e:
+        error = f"{type(e).__name__}: {str(e)[:180]}"
+
+    return {
+        "capture_id": record["capture_id"],
+        "kind": record["payload"].get("kind"),
+        "status": status,
+        "error": error,
+        "latency_sec": round(time.monotonic() - started, 4),
+        "original_duration_sec": record.get("duration_sec"),
+        "comment_matches": comment == record.get("response_comment") if error is None else False,
+    }
+
+
+def replay(records: List[dict], url: str, speed: float, concurrency: int, timeout: float) -> List[dict]:
+    results: List[dict] = []
+    lock = threading.Lock()
+
+    def _run(rec: dict) -> None:
+        out = send_one(url, rec, timeout)
+        with lock:
+            results.append(out)
+
+    t0_capture = records[0].get("received_at", 0.0) if records else 0.0
+    t0_wall = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for rec in records:
+            if speed > 0:
+                due = (rec.get("received_at", t0_capture) - t0_capture) / speed
+                wait_for = due - (time.monotonic() - t0_wall)
+                if wait_for > 0:
+                    time.sleep(wait_for)
+            pool.submit(_run, rec)
+
+    return results
+
+
+def summarize(results: List[dict], baseline: Optional[List[dict]] = None) -> str:
+    ok = [r for r in results if r["error"] is None]
+    lat = [r["latency_sec"] for r in ok]
+    orig = [r["original_duration_sec"] for r in ok if r.get("original_duration_sec") is not None]
+
+    lines = [
+        f"requests: {len(results)}  errors: {len(results) - len(ok)}  "
+        f"comment mismatches: {sum(1 for r in ok if not r['comment_matches'])}",
+        "            p50      p95      p99",
+        f"replay   {percentile(lat, 0.5):7.3f}  {percentile(lat, 0.95):7.3f}  {percentile(lat, 0.99):7.3f}",
+        f"original {percentile(orig, 0.5):7.3f}  {percentile(orig, 0.95):7.3f}  {percentile(orig, 0.99):7.3f}",
+    ]
+
+    if baseline:
+        base_lat = [r["latency_sec"] for r in baseline if r.get("error") is None]
+        lines.append(
+            f"baseline {percentile(base_lat, 0.5):7.3f}  {percentile(base_lat, 0.95):7.3f}  "
+            f"{percentile(base_lat, 0.99):7.3f}"
+        )
+        by_id = {r["capture_id"]: r for r in baseline}
+        deltas = sorted(
+            (
+                (r["latency_sec"] - by_id[r["capture_id"]]["latency_sec"], r["capture_id"])
+                for r in ok
+                if r["capture_id"] in by_id and by_id[r["capture_id"]].get("error") is None
+            ),
+            reverse=True,
+        )
+        if deltas:
+            lines.append("largest regressions vs baseline:")
+            for delta, cid in deltas[:5]:
+                lines.append(f"  {cid}  {delta:+.3f}s")
+
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Replay captured /analyze-review traffic.")
+    ap.add_argument("capture", help="capture JSONL file or capture directory")
+    ap.add_argument("--url", default="http://localhost:8000/analyze-review")
+    ap.add_argument("--speed", type=float, default=1.0, help="pacing multiplier; 0 = send as fast as possible")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--out", help="write per-request results as JSONL")
+    ap.add_argument("--compare", help="previous --out file to compare against")
+    args = ap.parse_args(argv)
+
+    records = [r for r in load_capture_records(args.capture) if r.get("capture_id") and r.get("payload")]
+    if not records:
+        print("no capture records found", file=sys.stderr)
+        return 1
+
+    results = replay(records, args.url, args.speed, args.concurrency, args.timeout)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            for r in results:
+                fh.write(json.dumps(r) + "\n")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fh:
+            baseline = [json.loads(line) for line in fh if line.strip()]
+
+    print(summarize(results, baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+# backend/test_admin.py
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    return TestClient(main.app)
+
+
+def test_non_ascii_admin_token_is_rejected_not_500(client):
+    resp = client.post("/admin/profile?seconds=0.1", headers={"x-admin-token": "s\xe9cret".encode("latin-1")})
+    assert resp.status_code == 403
+
+
+def test_admin_token_grants_profile(client):
+    resp = client.post("/admin/profile?seconds=0.1&hz=50", headers={"x-admin-token": "secret"})
+    assert resp.status_code == 200
+    assert resp.headers["content-disposition"].endswith("profile.collapsed")
+
+
+def test_missing_admin_token_is_forbidden(client):
+    assert client.post("/admin/profile?seconds=0.1").status_code == 403
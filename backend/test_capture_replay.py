@@ -0,0 +1,89 @@
+# backend/test_capture_replay.py
+import contextvars
+
+import pytest
+
+import main
+
+
+class FlakyModels:
+    """Answers with a 503 for the first `failures` calls, then succeeds."""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def generate_content(self, *, model, contents, config=None):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("503 UNAVAILABLE: model overloaded")
+        return main._ReplayResponse("final answer")
+
+
+class FlakyClient:
+    def __init__(self, failures):
+        self.models = FlakyModels(failures)
+
+
+def call(client):
+    return main.gemini_call_with_retry(
+        "classify_with_gemini",
+        lambda: main.gemini_generate(client, "classify_with_gemini", model="m", contents=[]).text,
+        initial_delay=0.01,
+        jitter=0.0,
+    )
+
+
+def capture(failures):
+    cap = {"model_calls": []}
+
+    def _run():
+        main._capture_ctx.set(cap)
+        return call(FlakyClient(failures))
+
+    return contextvars.copy_context().run(_run), cap["model_calls"]
+
+
+def test_capture_records_failed_attempts_and_sleeps():
+    text, calls = capture(failures=2)
+    assert text == "final answer"
+    assert [(c["kind"], c.get("outcome")) for c in calls] == [
+        ("attempt", "error"),
+        ("retry_sleep", None),
+        ("attempt", "error"),
+        ("retry_sleep", None),
+        ("attempt", "ok"),
+    ]
+    assert "503" in calls[0]["error"]
+    assert calls[1]["sleep_sec"] == 0.01
+
+
+def test_replay_reproduces_errors_and_sleeps(monkeypatch):
+    _, calls = capture(failures=2)
+    calls[1]["sleep_sec"] = 0.2  # replay waits as long as the capture says, not what the backoff computes
+    client = main.ReplayClient([{"capture_id": "c1", "model_calls": calls}])
+    monkeypatch.setattr(main, "REPLAY_FROM", "captures/")
+    monkeypatch.setattr(main, "_replay_client", client)
+    monkeypatch.setattr(main, "REPLAY_LATENCY_SCALE", 1.0)
+    replayed = {"model_calls": []}
+
+    def _run():
+        main._replay_id_ctx.set("c1")
+        main._capture_ctx.set(replayed)
+        started = main.time.monotonic()
+        return call(client), main.time.monotonic() - started
+
+    text, elapsed = contextvars.copy_context().run(_run)
+    assert text == "final answer"
+    assert elapsed >= 0.2
+    assert [c["sleep_sec"] for c in replayed["model_calls"] if c["kind"] == "retry_sleep"] == [0.2, calls[3]["sleep_sec"]]
+
+
+def test_replay_without_recorded_call_fails(monkeypatch):
+    client = main.ReplayClient([{"capture_id": "c1", "model_calls": []}])
+
+    def _run():
+        main._replay_id_ctx.set("c1")
+        return client.models.generate_content(model="m", contents=[], call_name="classify_with_gemini")
+
+    with pytest.raises(RuntimeError, match="no recorded response"):
+        contextvars.copy_context().run(_run)
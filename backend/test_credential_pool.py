@@ -0,0 +1,222 @@
+# backend/test_credential_pool.py
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class FakeKeyClient:
+    """
+    Stand-in for genai.Client bound to one API key. Enforces a per-key limit of
+    `limit` requests per `window` seconds and answers over-limit calls with a 429.
+    """
+
+    def __init__(self, api_key, limit=1000, window=60.0, retry_delay=None, fail_first=0):
+        self.api_key = api_key
+        self.limit = limit
+        self.window = window
+        self.retry_delay = retry_delay
+        self.fail_first = fail_first
+        self.calls = []
+        self.cached_names = set()
+        self._lock = threading.Lock()
+        self.models = self
+        self.caches = _FakeKeyCaches(self)
+
+    def _admit(self):
+        with self._lock:
+            now = time.monotonic()
+            self.calls = [t for t in self.calls if now - t < self.window]
+            self.calls.append(now)
+            over = len(self.calls) > self.limit or self.fail_first > 0
+            self.fail_first = max(0, self.fail_first - 1)
+        if over:
+            hint = f" {{'retryDelay': '{self.retry_delay}s'}}" if self.retry_delay is not None else ""
+            raise RuntimeError(f"429 RESOURCE_EXHAUSTED: quota exceeded for {self.api_key}{hint}")
+
+    def generate_content(self, *, model=None, contents=None, config=None):
+        self._admit()
+        cached = getattr(config, "cached_content", None)
+        if cached and cached not in self.cached_names:
+            raise RuntimeError(f"403 PERMISSION_DENIED: cached content {cached} belongs to another project")
+        return main._ReplayResponse(self.api_key)
+
+
+class _FakeKeyCaches:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, *, model=None, config=None):
+        self.client._admit()
+        name = f"cachedContents/{self.client.api_key}-{len(self.client.cached_names) + 1}"
+        self.client.cached_names.add(name)
+        return main._ReplayCachedContent(name)
+
+    def update(self, *, name, config=None):
+        self.client._admit()
+        return main._ReplayCachedContent(name)
+
+
+def make_pool(specs, **kw):
+    clients = {}
+
+    def factory(api_key):
+        clients[api_key] = FakeKeyClient(api_key, **specs[api_key])
+        return clients[api_key]
+
+    opts = dict(sideline_sec=0.2, max_sideline_sec=0.5, max_acquire_wait_sec=0.5)
+    opts.update(kw)
+    return main.CredentialPool(list(specs), factory, **opts), clients
+
+
+def generate(pool, **kw):
+    return pool.models.generate_content(model="m", contents=[], **kw).text
+
+
+def test_routes_to_key_with_most_headroom():
+    pool, _ = make_pool({"key-aaaa": {}, "key-bbbb": {}}, rpm_per_key=10)
+    served = [generate(pool) for _ in range(6)]
+    assert served.count("key-aaaa") == 3
+    assert served.count("key-bbbb") == 3
+    assert [k["requests_last_60s"] for k in pool.snapshot()["keys"]] == [3, 3]
+
+
+def test_throttled_key_is_sidelined_and_traffic_moves():
+    pool, clients = make_pool({"key-aaaa": {"limit": 1}, "key-bbbb": {}})
+    results = []
+    for _ in range(5):
+        try:
+            results.append(generate(pool))
+        except RuntimeError as e:
+            results.append("429" if "429" in str(e) else str(e))
+
+    assert results == ["key-aaaa", "key-bbbb", "429", "key-bbbb", "key-bbbb"]
+    stats = {k["key"]: k for k in pool.snapshot()["keys"]}
+    assert stats["key-1 (…aaaa)"]["throttled"] == 1
+    assert stats["key-1 (…aaaa)"]["sidelined_for_sec"] > 0
+
+
+def test_retry_delay_hint_is_honoured_but_capped():
+    pool, _ = make_pool({"key-aaaa": {"fail_first": 1, "retry_delay": 99}, "key-bbbb": {}}, max_sideline_sec=0.4)
+    try:
+        generate(pool)
+    except RuntimeError:
+        pass
+    sidelined = pool.snapshot()["keys"][0]["sidelined_for_sec"]
+    assert 0 < sidelined <= 0.4
+
+
+def test_all_keys_sidelined_waits_for_first_key():
+    pool, _ = make_pool({"key-aaaa": {"fail_first": 1}, "key-bbbb": {"fail_first": 1}})
+    for _ in range(2):
+        try:
+            generate(pool)
+        except RuntimeError:
+            pass
+
+    started = time.monotonic()
+    assert generate(pool) in ("key-aaaa", "key-bbbb")
+    assert 0.1 <= time.monotonic() - started < 1.0
+
+
+def test_single_key_429_recovers_within_retry_budget():
+    pool, clients = make_pool({"only-key": {"fail_first": 1}}, sideline_sec=30, max_sideline_sec=300)
+    out = main.gemini_call_with_retry("t", lambda: generate(pool), initial_delay=0.01, jitter=0.0)
+    assert out == "only-key"
+    assert len(clients["only-key"].calls) == 2
+    assert pool.snapshot()["keys"][0]["sidelined_for_sec"] == 0
+
+
+def test_backoff_resets_after_healthy_period():
+    pool, _ = make_pool({"key-aaaa": {"fail_first": 1}, "key-bbbb": {}}, sideline_sec=0.1, max_sideline_sec=1.0)
+    key = pool._keys[0]
+    try:
+        generate(pool)
+    except RuntimeError:
+        pass
+    assert key.consecutive_throttles == 1
+
+    time.sleep(0.25)  # sideline (0.1s) over and healthy for longer than it
+    pool.release(pool.acquire(owner=key), RuntimeError("429 quota"))
+    assert key.consecutive_throttles == 1
+    assert key.last_sideline_sec == 0.1
+
+
+def test_cached_content_is_pinned_to_creating_key():
+    pool, clients = make_pool({"key-aaaa": {}, "key-bbbb": {}})
+    cc = pool.caches.create(model="m")
+    owner = pool.cache_owner(cc.name)
+
+    for _ in range(4):
+        served = generate(pool, config=main.types.GenerateContentConfig(cached_content=cc.name))
+        assert served == owner.client.api_key
+
+
+def _cached_payload():
+    return main.ReviewPayload(
+        kind="review_comment",
+        pr_number=1,
+        repo_full_name="octo/repo",
+        project_context_docs=[main.ProjectContextDoc(path="docs/a.rst", excerpt="D" * 100)],
+    )
+
+
+@pytest.fixture
+def prompt_cache(monkeypatch):
+    cache = main.PromptPrefixCache(ttl_sec=600, refresh_margin_sec=60, max_entries=8, failure_backoff_sec=600)
+    monkeypatch.setattr(main, "_prompt_cache", cache)
+    monkeypatch.setattr(main, "PROMPT_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "PROMPT_CACHE_MIN_CHARS", 10)
+    return cache
+
+
+def test_throttled_cache_owner_sends_call_inline_and_keeps_cache(prompt_cache):
+    pool, clients = make_pool({"key-aaaa": {}, "key-bbbb": {}}, sideline_sec=5, max_sideline_sec=5)
+    payload = _cached_payload()
+
+    _, cached = main.build_prompt(pool, "m", "s", payload, "INSTR", "DYN")
+    owner = pool.cache_owner(cached)
+    pool.release(pool.acquire(owner=owner), RuntimeError("429 quota"))  # sideline the owner
+
+    def _call():
+        contents, name = main.build_prompt(pool, "m", "s", payload, "INSTR", "DYN")
+        return main.gemini_generate(
+            pool, "s", model="m", contents=contents, config=main.types.GenerateContentConfig(cached_content=name)
+        )
+
+    resp = main.gemini_call_with_retry("s", _call, initial_delay=0.0, jitter=0.0)
+    assert resp.text != owner.client.api_key
+    assert sum(len(c.cached_names) for c in clients.values()) == 1
+    assert prompt_cache.stats["invalidated"] == 0
+
+    owner.sidelined_until = 0.0  # owner back: the same cache is used again
+    assert main.build_prompt(pool, "m", "s", payload, "INSTR", "DYN")[1] == cached
+
+
+def test_owner_throttled_mid_call_does_not_invalidate(prompt_cache):
+    pool, _ = make_pool({"key-aaaa": {}, "key-bbbb": {}}, sideline_sec=5, max_sideline_sec=5)
+    _, cached = main.build_prompt(pool, "m", "s", _cached_payload(), "INSTR", "DYN")
+    pool.cache_owner(cached).sidelined_until = main.time.monotonic() + 5  # sidelined after build_prompt
+
+    with pytest.raises(main.CacheOwnerThrottled):
+        main.gemini_generate(
+            pool, "s", model="m", contents=[], config=main.types.GenerateContentConfig(cached_content=cached)
+        )
+    assert prompt_cache.stats["invalidated"] == 0
+    assert main._is_transient_gemini_error(main.CacheOwnerThrottled("owner is throttled; try again"))
+
+
+def test_refresh_with_sidelined_owner_does_not_recreate(prompt_cache):
+    pool, clients = make_pool({"key-aaaa": {}, "key-bbbb": {}}, sideline_sec=5, max_sideline_sec=5)
+    payload = _cached_payload()
+    _, cached = main.build_prompt(pool, "m", "s", payload, "INSTR", "DYN")
+    key = next(iter(prompt_cache._entries))
+    prompt_cache._entries[key]["expires_at"] = main.time.monotonic() + 5  # inside the refresh margin
+    pool.cache_owner(cached).sidelined_until = main.time.monotonic() + 5
+
+    contents, name = main.build_prompt(pool, "m", "s", payload, "INSTR", "DYN")
+    assert name is None and "INSTR" in contents[0].parts[0].text
+    assert sum(len(c.cached_names) for c in clients.values()) == 1
+    assert prompt_cache._entries[key]["name"] == cached
@@ -0,0 +1,120 @@
+# backend/test_hedging.py
+import threading
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_hedging(monkeypatch):
+    monkeypatch.setattr(main, "HEDGE_DEFAULT_DELAY_SEC", 0.05)
+    monkeypatch.setattr(main, "_hedge_stats", {})
+    monkeypatch.setattr(main, "_hedge_latency", {})
+    monkeypatch.setattr(main, "_hedge_tokens", main.HEDGE_BUDGET_BURST)
+    monkeypatch.setattr(main, "_hedge_slots", threading.BoundedSemaphore(4))
+    pool = main.ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(main, "_hedge_pool", pool)
+    yield
+    pool.shutdown(wait=True)  # let losing calls finish before the next test's state is installed
+
+
+def slow_fn(*delays, fail=()):
+    """Call n sleeps delays[n] and returns n, or raises if n is in `fail`."""
+    calls = []
+    lock = threading.Lock()
+
+    def _fn():
+        with lock:
+            n = len(calls)
+            calls.append(n)
+        time.sleep(delays[n])
+        if n in fail:
+            raise RuntimeError(f"call {n} failed")
+        return n
+
+    return _fn, calls
+
+
+def stats():
+    return main._hedge_stats["s"]
+
+
+def test_fast_primary_does_not_hedge():
+    fn, calls = slow_fn(0.0)
+    assert main._run_hedged("s", fn) == 0
+    assert calls == [0]
+    assert stats()["primary_wins"] == 1
+    assert stats()["hedges_fired"] == 0
+    assert len(main._hedge_latency["s"].samples) == 1
+
+
+def test_slow_primary_fires_hedge_that_wins():
+    fn, calls = slow_fn(0.5, 0.0)
+    started = time.monotonic()
+    assert main._run_hedged("s", fn) == 1
+    assert time.monotonic() - started < 0.4
+    assert calls == [0, 1]
+    assert stats()["hedges_fired"] == 1
+    assert stats()["hedge_wins"] == 1
+    assert stats()["primary_wins"] == 0
+
+
+def test_primary_wins_after_hedge_fired():
+    fn, _ = slow_fn(0.1, 0.5)
+    assert main._run_hedged("s", fn) == 0
+    assert stats()["hedges_fired"] == 1
+    assert stats()["primary_wins"] == 1
+    assert stats()["hedge_wins"] == 0
+
+
+def test_budget_denied_waits_for_primary(monkeypatch):
+    monkeypatch.setattr(main, "_hedge_tokens", 0.0)
+    fn, calls = slow_fn(0.15)
+    assert main._run_hedged("s", fn) == 0
+    assert calls == [0]
+    assert stats()["budget_denied"] == 1
+    assert stats()["primary_wins"] == 1
+
+
+def test_primary_error_is_not_a_win():
+    fn, _ = slow_fn(0.0, fail={0})
+    with pytest.raises(RuntimeError, match="call 0 failed"):
+        main._run_hedged("s", fn)
+    assert stats()["errors"] == 1
+    assert stats()["primary_wins"] == 0
+    assert "s" not in main._hedge_latency
+
+
+def test_hedge_covers_failing_primary():
+    fn, _ = slow_fn(0.2, 0.0, fail={0})
+    assert main._run_hedged("s", fn) == 1
+    assert stats()["hedge_wins"] == 1
+    assert stats()["errors"] == 0
+
+
+def test_both_calls_failing_counts_one_error():
+    fn, _ = slow_fn(0.1, 0.0, fail={0, 1})
+    with pytest.raises(RuntimeError):
+        main._run_hedged("s", fn)
+    assert stats()["errors"] == 1
+    assert stats()["hedge_wins"] == stats()["primary_wins"] == 0
+
+
+def test_saturated_pool_runs_inline_without_hedging(monkeypatch):
+    monkeypatch.setattr(main, "_hedge_slots", threading.BoundedSemaphore(1))
+    main._hedge_slots.acquire()  # every worker busy
+    fn, calls = slow_fn(0.15)
+    caller = threading.current_thread().name
+    ran_on = []
+
+    def _fn():
+        ran_on.append(threading.current_thread().name)
+        return fn()
+
+    assert main._run_hedged("s", _fn) == 0
+    assert ran_on == [caller]
+    assert stats()["pool_saturated"] == 1
+    assert stats()["hedges_fired"] == 0
+    assert main._hedge_latency["s"].samples[0] < 0.3
@@ -0,0 +1,120 @@
+# backend/test_prepare_pr.py
+import asyncio
+import threading
+import time
+
+import main
+
+
+def fake_review(calls, fail=False, delay=0.0):
+    def _review(payload):
+        calls.append(payload.pr_head_sha)
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError("model down")
+        cap = main._capture_ctx.get()
+        if cap is not None:
+            cap["model_calls"].append({"call_name": "wizard_review_candidates", "latency_sec": 0.0, "response_text": "{}"})
+        return [main.CandidateReviewComment(title="T", description="D", file_path="a.py")]
+
+    return _review
+
+
+def test_failed_precompute_is_rescheduled(monkeypatch, wizard_payload):
+    calls = []
+
+    async def scenario():
+        monkeypatch.setattr(main, "review_wizard_candidates", fake_review(calls, fail=True))
+        assert main.schedule_prepare(wizard_payload()).status == "scheduled"
+        await asyncio.sleep(0.1)
+        assert main._prepared == {}
+
+        monkeypatch.setattr(main, "review_wizard_candidates", fake_review(calls))
+        assert main.schedule_prepare(wizard_payload()).status == "scheduled"
+        await asyncio.sleep(0.1)
+        assert main.schedule_prepare(wizard_payload()).status == "cached"
+
+    asyncio.run(scenario())
+    assert calls == ["head1", "head1"]
+    assert main._prepared_stats["failures"] == 1
+
+
+def test_precompute_concurrency_is_capped(monkeypatch, wizard_payload):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def _review(payload):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return []
+
+    async def scenario():
+        monkeypatch.setattr(main, "_prepare_semaphore", asyncio.Semaphore(2))
+        monkeypatch.setattr(main, "review_wizard_candidates", _review)
+        for n in range(6):
+            p = wizard_payload().model_copy(update={"pr_number": n})
+            main.schedule_prepare(p)
+        await asyncio.gather(*(e["task"] for e in main._prepared.values()))
+
+    asyncio.run(scenario())
+    assert len(peak) == 6
+    assert max(peak) <= 2
+
+
+def test_served_review_carries_precompute_model_calls(monkeypatch, wizard_payload):
+    calls = []
+    monkeypatch.setattr(main, "_capture_writer", object())  # capture enabled; nothing is written here
+    monkeypatch.setattr(main, "review_wizard_candidates", fake_review(calls))
+
+    async def scenario():
+        main.schedule_prepare(wizard_payload())
+        cap = {"model_calls": []}
+        main._capture_ctx.set(cap)
+        review = await main.prepared_wizard_review(wizard_payload())
+        return review, cap
+
+    review, cap = asyncio.run(scenario())
+    assert "### 1) T" in review
+    assert cap["served_from_prepare"] is True
+    assert [c["call_name"] for c in cap["model_calls"]] == ["wizard_review_candidates"]
+
+
+def test_command_with_instructions_is_not_served_from_cache(monkeypatch, wizard_payload):
+    monkeypatch.setattr(main, "review_wizard_candidates", fake_review([]))
+
+    async def scenario():
+        main.schedule_prepare(wizard_payload())
+        await asyncio.sleep(0.1)
+        return await main.prepared_wizard_review(wizard_payload(body="/wizard-review focus on tests"))
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_served_review_is_single_use_so_deferred_files_get_reviewed(monkeypatch, wizard_payload):
+    shown = []
+
+    def _review(payload):
+        shown.append([f.filename for f in payload.files[: main.LLM_CONTEXT_MAX_PATCHES]])
+        return []
+
+    monkeypatch.setattr(main, "review_wizard_candidates", _review)
+    files = [main.FileInfo(filename=f"f{i}.py", status="modified", patch=f"@@ -1 +1 @@\n+{i}\n") for i in range(8)]
+    main.run_incremental_wizard_review(wizard_payload(files[:1]))
+    payload = wizard_payload(files)
+
+    async def scenario():
+        main.schedule_prepare(payload)
+        first = await main.prepared_wizard_review(payload)
+        second = await main.prepared_wizard_review(payload)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert "left 1 more changed file(s)" in first
+    assert second is None
+    assert "re-reviewed 1 changed file(s)" in main.run_incremental_wizard_review(payload)
+    assert shown[-1] == ["f7.py"]
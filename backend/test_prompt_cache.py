@@ -0,0 +1,187 @@
+# backend/test_prompt_cache.py
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class FakeCaches:
+    """Local cached-content provider: counts registrations, can be slowed down."""
+
+    def __init__(self, create_delay: float = 0.0):
+        self.create_delay = create_delay
+        self.created = []
+        self.updated = []
+        self._lock = threading.Lock()
+
+    def create(self, *, model, config=None):
+        time.sleep(self.create_delay)
+        with self._lock:
+            name = f"cachedContents/fake-{len(self.created) + 1}"
+            self.created.append(name)
+        return main._ReplayCachedContent(name)
+
+    def update(self, *, name, config=None):
+        self.updated.append(name)
+        return main._ReplayCachedContent(name)
+
+
+class FakeModels:
+    """Rejects cached-content names listed in `rejected`, echoes the prompt otherwise."""
+
+    def __init__(self):
+        self.rejected = set()
+        self.requests = []
+
+    def generate_content(self, *, model, contents, config=None):
+        cached = getattr(config, "cached_content", None)
+        self.requests.append((cached, contents[0].parts[0].text))
+        if cached in self.rejected:
+            raise RuntimeError(f"400 INVALID_ARGUMENT: cached content {cached} not found")
+        return main._ReplayResponse("ok")
+
+
+class FakeProvider:
+    def __init__(self, create_delay: float = 0.0):
+        self.caches = FakeCaches(create_delay)
+        self.models = FakeModels()
+
+
+def make_payload(docs="D" * 200, sha="abc123"):
+    return main.ReviewPayload(
+        kind="review_comment",
+        pr_number=7,
+        repo_full_name="octo/repo",
+        repo_default_branch_sha=sha,
+        project_context_docs=[main.ProjectContextDoc(path="docs/style.rst", excerpt=docs)],
+    )
+
+
+def make_cache(**kw):
+    opts = dict(ttl_sec=600, refresh_margin_sec=60, max_entries=8, failure_backoff_sec=600)
+    opts.update(kw)
+    return main.PromptPrefixCache(**opts)
+
+
+@pytest.fixture
+def cache_enabled(monkeypatch):
+    cache = make_cache()
+    monkeypatch.setattr(main, "PROMPT_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "PROMPT_CACHE_MIN_CHARS", 10)
+    monkeypatch.setattr(main, "_prompt_cache", cache)
+    return cache
+
+
+def test_prefix_key_is_stable_and_content_addressed():
+    p = make_payload()
+    k1 = main.prompt_prefix_key(p, "m", "classify", "INSTR\n\nDOCS")
+    assert k1 == main.prompt_prefix_key(make_payload(), "m", "classify", "INSTR\n\nDOCS")
+    assert k1.startswith("octo/repo@abc123|m|classify|")
+    assert k1 != main.prompt_prefix_key(p, "m", "classify", "INSTR\n\nDOCS v2")
+    assert k1 != main.prompt_prefix_key(make_payload(sha="def456"), "m", "classify", "INSTR\n\nDOCS")
+    assert k1 != main.prompt_prefix_key(p, "m", "clarify", "INSTR\n\nDOCS")
+
+
+def test_static_prefix_leads_inline_prompt():
+    contents, cached = main.build_prompt(FakeProvider(), "m", "s", make_payload(docs="STYLE"), "INSTR", "CONTEXT:\nPR")
+    text = contents[0].parts[0].text
+    assert cached is None
+    assert text.index("INSTR") < text.index("STYLE") < text.index("CONTEXT:\nPR")
+
+
+def test_resolve_hits_after_create(cache_enabled):
+    fake = FakeProvider()
+    first = main.build_prompt(fake, "m", "s", make_payload(), "INSTR", "DYN")
+    second = main.build_prompt(fake, "m", "s", make_payload(), "INSTR", "DYN")
+    assert first[1] == second[1] == "cachedContents/fake-1"
+    assert second[0][0].parts[0].text == "DYN"
+    assert len(fake.caches.created) == 1
+    assert cache_enabled.stats["hits"] == 1
+
+
+def test_refresh_extends_ttl_near_expiry():
+    cache = make_cache(refresh_margin_sec=60)
+    fake = FakeProvider()
+    name = cache.resolve(fake, "m", "k", "INSTR", "DOCS")
+    cache._entries["k"]["expires_at"] = time.monotonic() + 5  # inside the refresh margin
+
+    assert cache.resolve(fake, "m", "k", "INSTR", "DOCS") == name
+    assert fake.caches.updated == [name]
+    assert len(fake.caches.created) == 1
+    assert cache._entries["k"]["expires_at"] > time.monotonic() + 500
+
+
+def test_expired_entry_is_recreated():
+    cache = make_cache()
+    fake = FakeProvider()
+    cache.resolve(fake, "m", "k", "INSTR", "DOCS")
+    cache._entries["k"]["expires_at"] = time.monotonic() - 1
+
+    assert cache.resolve(fake, "m", "k", "INSTR", "DOCS") == "cachedContents/fake-2"
+    assert fake.caches.updated == []
+
+
+def test_lru_eviction():
+    cache = make_cache(max_entries=2)
+    fake = FakeProvider()
+    cache.resolve(fake, "m", "a", "I", "D")
+    cache.resolve(fake, "m", "b", "I", "D")
+    cache.resolve(fake, "m", "a", "I", "D")  # touch a, so b is least recent
+    cache.resolve(fake, "m", "c", "I", "D")
+
+    assert list(cache._entries) == ["a", "c"]
+    cache.resolve(fake, "m", "b", "I", "D")
+    assert len(fake.caches.created) == 4
+
+
+def test_concurrent_cold_key_creates_once():
+    cache = make_cache()
+    fake = FakeProvider(create_delay=0.2)
+    results = []
+
+    def _resolve():
+        results.append(cache.resolve(fake, "m", "k", "INSTR", "DOCS"))
+
+    threads = [threading.Thread(target=_resolve) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert fake.caches.created == ["cachedContents/fake-1"]
+    assert results == ["cachedContents/fake-1"] * 4
+
+
+def test_replay_stand_in_accepts_registrations(cache_enabled):
+    client = main.ReplayClient([])
+    _, cached = main.build_prompt(client, "m", "s", make_payload(), "INSTR", "DYN")
+    assert cached.startswith("cachedContents/replay-")
+    assert client.caches.created == 1
+
+
+def test_rejected_name_falls_back_inline_without_recreating(cache_enabled):
+    fake = FakeProvider()
+    payload = make_payload()
+    main.build_prompt(fake, "m", "s", payload, "INSTR", "DYN")
+    fake.models.rejected.add("cachedContents/fake-1")
+
+    def _call():
+        contents, cached = main.build_prompt(fake, "m", "s", payload, "INSTR", "DYN")
+        return main.gemini_generate(
+            fake,
+            "s",
+            model="m",
+            contents=contents,
+            config=main.types.GenerateContentConfig(cached_content=cached),
+        )
+
+    resp = main.gemini_call_with_retry("s", _call, initial_delay=0.0, jitter=0.0)
+
+    assert resp.text == "ok"
+    assert len(fake.caches.created) == 1
+    cached, text = fake.models.requests[-1]
+    assert cached is None
+    assert text.startswith("INSTR") and "DYN" in text
+    assert cache_enabled.stats["invalidated"] == 1
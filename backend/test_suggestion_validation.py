@@ -0,0 +1,151 @@
+# backend/test_suggestion_validation.py
+import main
+
+A_PATCH = """@@ -10,4 +10,5 @@ def load(path):
+ def load(path):
+     with open(path) as fh:
+-        data = fh.read()
++        data = fh.read().strip()
++        log(data)
+     return data
+"""
+
+B_PATCH = """@@ -1,3 +1,3 @@
+ import os
+-DEBUG = True
++DEBUG = False
+ TIMEOUT = 5
+"""
+
+
+def make_payload(comment_path=None):
+    return main.ReviewPayload(
+        kind="review" if comment_path is None else "review_comment",
+        pr_number=1,
+        repo_full_name="octo/repo",
+        comment_path=comment_path,
+        files=[
+            main.FileInfo(filename="a.py", status="modified", patch=A_PATCH),
+            main.FileInfo(filename="b.py", status="modified", patch=B_PATCH),
+        ],
+    )
+
+
+def fenced(*lines):
+    return "\n".join(["```diff", *lines, "```"])
+
+
+def test_matching_block_passes_byte_for_byte_except_hunk_numbers():
+    block = fenced(
+        "--- a/a.py",
+        "+++ b/a.py",
+        "@@ -1,2 +1,2 @@ def load(path):",
+        "         data = fh.read().strip()",
+        "-        log(data)",
+        "+        log.debug(data)",
+    )
+    status, out = main.validate_suggestion_locally(make_payload("a.py"), block)
+    assert status == "passed"
+    assert out == block.replace("@@ -1,2 +1,2 @@", "@@ -12,2 +12,2 @@")
+
+
+def test_whitespace_mismatch_is_reindented():
+    block = fenced(
+        "@@",
+        "  data = fh.read().strip()",
+        "- log(data)",
+        "+ if data:",
+        "+     log(data)",
+    )
+    status, out = main.validate_suggestion_locally(make_payload("a.py"), block)
+    assert status == "fixed_locally"
+    assert out.splitlines()[2:6] == [
+        "         data = fh.read().strip()",
+        "-        log(data)",
+        "+        if data:",
+        "+            log(data)",
+    ]
+
+
+def test_inconsistent_indent_fails_instead_of_mixing():
+    block = fenced(
+        "@@",
+        "-    data = fh.read().strip()",
+        "-log(data)",
+        "+log(data, level=1)",
+    )
+    status, _ = main.validate_suggestion_locally(make_payload("a.py"), block)
+    assert status == "failed"
+
+
+def test_unknown_context_is_trimmed():
+    block = fenced(
+        "@@",
+        " # invented comment line",
+        "-        log(data)",
+        "+        log.debug(data)",
+        "     return data",
+    )
+    status, out = main.validate_suggestion_locally(make_payload("a.py"), block)
+    assert status == "fixed_locally"
+    assert out == fenced("@@ -13,1 +13,1 @@", "-        log(data)", "+        log.debug(data)")
+
+
+def test_multi_file_diff_keeps_file_headers():
+    block = fenced(
+        "diff --git a/a.py b/a.py",
+        "--- a/a.py",
+        "+++ b/a.py",
+        "@@ -1 +1,2 @@",
+        "-        log(data)",
+        "+        log(data)",
+        "+        return data",
+        "diff --git a/b.py b/b.py",
+        "--- a/b.py",
+        "+++ b/b.py",
+        "@@ -9 +9 @@",
+        "-DEBUG = False",
+        "+DEBUG = os.getenv('DEBUG') == '1'",
+    )
+    status, out = main.validate_suggestion_locally(make_payload(), block)
+    assert status == "passed"
+    lines = out.splitlines()
+    assert lines[1:4] == ["diff --git a/a.py b/a.py", "--- a/a.py", "+++ b/a.py"]
+    assert lines[4] == "@@ -13,1 +13,2 @@"
+    assert lines[8:11] == ["diff --git a/b.py b/b.py", "--- a/b.py", "+++ b/b.py"]
+    assert lines[11] == "@@ -2,1 +2,1 @@"  # no carry-over of a.py's +1 line shift
+
+
+def test_hunk_only_aligns_against_its_own_file():
+    block = fenced(
+        "--- a/b.py",
+        "+++ b/b.py",
+        "@@",
+        "-        log(data)",
+        "+        log.debug(data)",
+    )
+    status, _ = main.validate_suggestion_locally(make_payload(), block)
+    assert status == "failed"
+
+
+def test_failed_block_is_repaired(monkeypatch):
+    bad = fenced("@@", "-        log(payload)", "+        log.debug(payload)")
+    good = fenced("@@", "-        log(data)", "+        log.debug(data)")
+    seen = []
+
+    def fake_repair(payload, block):
+        seen.append(main._repair_reference_excerpt(payload, block))
+        return good
+
+    monkeypatch.setattr(main, "repair_code_suggestion", fake_repair)
+    before = main.suggestion_validation_snapshot()["repaired"]
+
+    out = main.validate_and_repair_suggestion(make_payload("a.py"), bad)
+    assert out == fenced("@@ -13,1 +13,1 @@", "-        log(data)", "+        log.debug(data)")
+    assert "13:         log(data)" in seen[0]
+    assert main.suggestion_validation_snapshot()["repaired"] == before + 1
+
+
+def test_non_diff_block_is_skipped():
+    block = "```suggestion\nlog.debug(data)\n```"
+    assert main.validate_suggestion_locally(make_payload("a.py"), block) == ("skipped", block)
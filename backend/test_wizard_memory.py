@@ -0,0 +1,105 @@
+# backend/test_wizard_memory.py
+import asyncio
+
+import pytest
+
+import main
+
+KEY = ("octo/repo", 3)
+
+
+def make_file(name, version="1"):
+    return main.FileInfo(filename=name, status="modified", patch=f"@@ -1 +1 @@\n-old\n+{name} v{version}\n")
+
+
+@pytest.fixture
+def reviewed(monkeypatch):
+    """Records the files each model call was shown and answers with one comment per shown file."""
+    calls = []
+
+    def _review(payload):
+        shown = [f.filename for f in (payload.files or [])[: main.LLM_CONTEXT_MAX_PATCHES]]
+        calls.append(shown)
+        return [main.CandidateReviewComment(title=f"on {n}", description="D", file_path=n) for n in shown]
+
+    monkeypatch.setattr(main, "review_wizard_candidates", _review)
+    return calls
+
+
+def remembered_titles():
+    return {name: [c.title for c in e["comments"]] for name, e in main._wizard_memory[KEY]["files"].items()}
+
+
+def test_changed_file_comments_are_replaced(reviewed, wizard_payload):
+    main.run_incremental_wizard_review(wizard_payload([make_file("a.py"), make_file("b.py")]))
+
+    body = main.run_incremental_wizard_review(wizard_payload([make_file("a.py"), make_file("b.py", version="2")]))
+    assert reviewed[-1] == ["b.py"]
+    assert body.count("on b.py") == 1
+    assert "re-reviewed 1 changed file(s), reused 1 earlier comment(s) on 1 unchanged file(s)" in body
+    assert "dropped 1 earlier comment(s)" in body
+    assert remembered_titles() == {"a.py": ["on a.py"], "b.py": ["on b.py"]}
+    assert main._wizard_memory[KEY]["files"]["b.py"]["patch_hash"] == main._file_patch_hash(make_file("b.py", "2"))
+
+
+def test_comments_on_removed_file_are_dropped(reviewed, wizard_payload):
+    main.run_incremental_wizard_review(wizard_payload([make_file("a.py"), make_file("b.py")]))
+
+    body = main.run_incremental_wizard_review(wizard_payload([make_file("a.py")]))
+    assert len(reviewed) == 1  # nothing changed, so no model call for the second run
+    assert "on b.py" not in body
+    assert "dropped 1 earlier comment(s)" in body
+    assert remembered_titles() == {"a.py": ["on a.py"]}
+
+
+def test_command_with_instructions_does_not_touch_memory(reviewed, wizard_payload):
+    main.run_incremental_wizard_review(wizard_payload([make_file("a.py"), make_file("b.py")]))
+    before = main._wizard_memory[KEY]
+
+    narrowed = wizard_payload([make_file("a.py"), make_file("b.py")], body="/wizard-review only naming")
+    main.run_incremental_wizard_review(narrowed)
+    assert main._wizard_memory[KEY] is before
+
+    main._wizard_memory.clear()
+    main.run_incremental_wizard_review(narrowed)
+    assert KEY not in main._wizard_memory
+
+
+def test_files_past_context_cap_are_reviewed_next_run(reviewed, wizard_payload):
+    files = [make_file(f"f{i}.py") for i in range(8)]
+    main.run_incremental_wizard_review(wizard_payload(files))
+    assert sorted(main._wizard_memory[KEY]["files"]) == [f"f{i}.py" for i in range(6)]
+
+    body = main.run_incremental_wizard_review(wizard_payload(files))
+    assert reviewed[-1] == ["f6.py", "f7.py"]
+    assert "re-reviewed 2 changed file(s)" in body
+    assert len(main._wizard_memory[KEY]["files"]) == 8
+
+
+def test_deferred_files_are_reported(reviewed, wizard_payload):
+    main.run_incremental_wizard_review(wizard_payload([make_file("a.py")]))
+    files = [make_file("a.py")] + [make_file(f"n{i}.py") for i in range(7)]
+
+    body = main.run_incremental_wizard_review(wizard_payload(files))
+    assert reviewed[-1] == [f"n{i}.py" for i in range(6)]
+    assert "left 1 more changed file(s) for the next run" in body
+    assert "n6.py" not in main._wizard_memory[KEY]["files"]
+
+
+def test_precompute_only_reviews_changed_files(reviewed, wizard_payload):
+    async def scenario():
+        head1 = wizard_payload([make_file("a.py"), make_file("b.py")])
+        main.schedule_prepare(head1)
+        first = await main.prepared_wizard_review(head1)
+
+        head2 = wizard_payload([make_file("a.py"), make_file("b.py", version="2")], sha="head2")
+        main.schedule_prepare(head2)
+        second = await main.prepared_wizard_review(head2)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert reviewed == [["a.py", "b.py"], ["b.py"]]
+    assert "Incremental re-review" not in first
+    assert "re-reviewed 1 changed file(s), reused 1 earlier comment(s)" in second
+    assert "on a.py" in second and "on b.py" in second
+    assert main._prepared_stats["hits"] == 2
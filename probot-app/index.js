@@ -60,6 +60,37 @@ async function callBackend(context, payloadForBackend) {
   }
 }
 
+/**
+ * Prepare endpoint: defaults to BACKEND_URL with /analyze-review swapped for /prepare-pr
+ */
+function getPrepareUrl(context) {
+  if (process.env.PREPARE_PR_URL) return process.env.PREPARE_PR_URL;
+  const backendUrl = getBackendUrl(context);
+  if (!backendUrl) return null;
+  return backendUrl.replace(/\/analyze-review\/?$/, "/prepare-pr");
+}
+
+/**
+ * Ask backend to precompute the wizard review for a PR head (fire-and-forget)
+ */
+async function callPrepare(context, payloadForBackend) {
+  const prepareUrl = getPrepareUrl(context);
+  if (!prepareUrl || prepareUrl === process.env.BACKEND_URL) return;
+
+  try {
+    const res = await axios.post(prepareUrl, payloadForBackend, {
+      headers: { "Content-Type": "application/json" },
+      timeout: 10_000
+    });
+    context.log.info(
+      { pr: payloadForBackend.pr_number, status: res?.data?.status },
+      "Requested PR precompute"
+    );
+  } catch (err) {
+    context.log.warn({ err }, "Error calling prepare endpoint");
+  }
+}
+
 /**
  * Helper: fetch changed files for a PR (includes unified diff patch when available)
  */
@@ -218,6 +249,31 @@ async function listRepoFilesRecursive(context, owner, repo, branch) {
     .map((it) => it.path);
 }
 
+// Default-branch head SHA; scopes the backend's cached prompt prefix (docs) per commit
+const _shaCache = new Map(); // `${owner}/${repo}@${branch}` -> { at, sha }
+
+async function getDefaultBranchSha(context, owner, repo, branch) {
+  const key = `${owner}/${repo}@${branch}`;
+  const now = Date.now();
+  const cached = _shaCache.get(key);
+  if (cached && now - cached.at < CACHE_TTL_MS) return cached.sha;
+
+  let sha = null;
+  try {
+    const refRes = await context.octokit.git.getRef({
+      owner,
+      repo,
+      ref: `heads/${branch}`
+    });
+    sha = refRes.data.object.sha;
+  } catch (e) {
+    context.log.warn({ e }, "Could not resolve default branch SHA");
+  }
+
+  _shaCache.set(key, { at: now, sha });
+  return sha;
+}
+
 function normalizeExt(ext) {
   if (!ext) return "";
   return ext.startsWith(".") ? ext.toLowerCase() : `.${ext.toLowerCase()}`;
@@ -329,6 +385,12 @@ async function buildReviewCommentPayload(context) {
     repoName,
     defaultBranch
   );
+  const defaultBranchSha = await getDefaultBranchSha(
+    context,
+    owner,
+    repoName,
+    defaultBranch
+  );
 
   return {
     kind: "review_comment",
@@ -347,10 +409,12 @@ async function buildReviewCommentPayload(context) {
     pr_title: pr.title,
     pr_body: pr.body,
     pr_author_login: pr.user && pr.user.login,
+    pr_head_sha: pr.head && pr.head.sha,
     repo_full_name: repo.full_name,
     repo_owner: owner,
     repo_name: repoName,
     repo_default_branch: defaultBranch,
+    repo_default_branch_sha: defaultBranchSha,
 
     files,
     project_context_docs,
@@ -381,6 +445,12 @@ async function buildReviewPayload(context) {
     repoName,
     defaultBranch
   );
+  const defaultBranchSha = await getDefaultBranchSha(
+    context,
+    owner,
+    repoName,
+    defaultBranch
+  );
 
   return {
     kind: "review",
@@ -399,10 +469,12 @@ async function buildReviewPayload(context) {
     pr_title: pr.title,
     pr_body: pr.body,
     pr_author_login: pr.user && pr.user.login,
+    pr_head_sha: pr.head && pr.head.sha,
     repo_full_name: repo.full_name,
     repo_owner: owner,
     repo_name: repoName,
     repo_default_branch: defaultBranch,
+    repo_default_branch_sha: defaultBranchSha,
 
     files,
     project_context_docs,
@@ -434,6 +506,12 @@ async function buildIssueCommentPayload(context) {
     repoName,
     defaultBranch
   );
+  const defaultBranchSha = await getDefaultBranchSha(
+    context,
+    owner,
+    repoName,
+    defaultBranch
+  );
 
   return {
     kind: "issue_comment",
@@ -452,10 +530,68 @@ async function buildIssueCommentPayload(context) {
     pr_title: pr.title,
     pr_body: pr.body,
     pr_author_login: pr.user && pr.user.login,
+    pr_head_sha: pr.head && pr.head.sha,
+    repo_full_name: repo.full_name,
+    repo_owner: owner,
+    repo_name: repoName,
+    repo_default_branch: defaultBranch,
+    repo_default_branch_sha: defaultBranchSha,
+
+    files,
+    project_context_docs,
+    review_comments: null
+  };
+}
+
+/**
+ * Build backend payload for PR opened/synchronize (precompute, no reply)
+ */
+async function buildPreparePayload(context) {
+  const pr = context.payload.pull_request;
+  const repo = context.payload.repository;
+
+  const owner = repo.owner.login;
+  const repoName = repo.name;
+  const prNumber = pr.number;
+  const defaultBranch = repo.default_branch;
+
+  const files = await getPrFiles(context, owner, repoName, prNumber);
+  const project_context_docs = await getProjectContextDocs(
+    context,
+    owner,
+    repoName,
+    defaultBranch
+  );
+  const defaultBranchSha = await getDefaultBranchSha(
+    context,
+    owner,
+    repoName,
+    defaultBranch
+  );
+
+  return {
+    kind: "prepare_pr",
+
+    review_body: null,
+    review_state: null,
+
+    comment_body: null,
+    comment_path: null,
+    comment_diff_hunk: null,
+    comment_position: null,
+    comment_id: null,
+
+    reviewer_login: context.payload.sender && context.payload.sender.login,
+    pr_number: prNumber,
+    pr_title: pr.title,
+    pr_body: pr.body,
+    pr_author_login: pr.user && pr.user.login,
+    pr_head_sha: pr.head && pr.head.sha,
     repo_full_name: repo.full_name,
     repo_owner: owner,
     repo_name: repoName,
     repo_default_branch: defaultBranch,
+    repo_default_branch_sha: defaultBranchSha,
 
     files,
     project_context_docs,
@@ -595,4 +731,29 @@ module.exports = (app) => {
       context.log.error({ err }, "Error while handling issue_comment.created for PR");
     }
   });
+
+  // ----------------------------------------------
+  // 4) Precompute wizard review when the PR head moves
+  // ----------------------------------------------
+  app.on(
+    [
+      "pull_request.opened",
+      "pull_request.synchronize",
+      "pull_request.reopened",
+      "pull_request.ready_for_review"
+    ],
+    async (context) => {
+      try {
+        if (isFromBot(context)) return;
+
+        const pr = context.payload.pull_request;
+        if (!pr || pr.draft) return;
+
+        const payloadForBackend = await buildPreparePayload(context);
+        await callPrepare(context, payloadForBackend);
+      } catch (err) {
+        context.log.error({ err }, "Error while handling pull_request head update");
+      }
+    }
+  );
 };